@@ -0,0 +1,110 @@
+import math
+import threading
+from collections import deque
+
+# Prompt length is measured in units of this many characters, so a 3000 character prompt is
+# expected to take longer than a one-liner by the same per-unit rate
+CHARS_PER_LENGTH_UNIT = 1000
+
+class AdaptiveTimingController:
+    # Learns how long SecureGPT takes to answer from the completions seen so far, in place of the static
+    # --generation_sleep_timer/--max_data_loading_retries/--retry_data_loading_wait_time budget.
+    # Every observed latency is divided by the prompt's length units, so short and long prompts feed the
+    # same model. A row waits at most the recent `quantile` of that rate times its own length units times
+    # `safety_factor`, and every timeout backs the deadlines off until completions come back.
+    # One controller is shared by all sessions, since they all see the same server load
+    def __init__(
+            self,
+            max_response_timeout,
+            max_input_timeout,
+            min_response_timeout=10,
+            min_input_timeout=2,
+            window_size=50,
+            min_samples=5,
+            quantile=0.95,
+            safety_factor=1.5,
+            ewma_alpha=0.2,
+            backoff_multiplier=1.5,
+    ):
+        self.max_response_timeout = max_response_timeout
+        self.max_input_timeout = max_input_timeout
+        self.min_response_timeout = min(min_response_timeout, max_response_timeout)
+        self.min_input_timeout = min(min_input_timeout, max_input_timeout)
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self.safety_factor = safety_factor
+        self.ewma_alpha = ewma_alpha
+        self.backoff_multiplier = backoff_multiplier
+        self.response_rates = deque(maxlen=window_size) # Seconds per length unit of recent completions
+        self.input_rates = deque(maxlen=window_size)
+        self.response_rate_ewma = None
+        self.backoff_factor = 1.0
+        self.completed_responses = 0
+        self.timed_out_responses = 0
+        self.lock = threading.Lock()
+
+    def get_response_timeout(self, prompt_chars):
+        with self.lock:
+            if len(self.response_rates) < self.min_samples:
+                return self.max_response_timeout
+            rate = get_quantile(self.response_rates, self.quantile)
+            backoff_factor = self.backoff_factor
+        timeout = rate * get_length_units(prompt_chars) * self.safety_factor * backoff_factor
+        return min(max(timeout, self.min_response_timeout), self.max_response_timeout)
+
+    def get_poll_frequency(self, prompt_chars):
+        # About 20 polls over the expected response time: short replies are noticed sooner,
+        # long ones don't hammer the page with execute_script calls
+        with self.lock:
+            response_rate_ewma = self.response_rate_ewma
+        if response_rate_ewma is None:
+            return 0.5
+        return min(max(response_rate_ewma * get_length_units(prompt_chars) / 20, 0.2), 2.0)
+
+    def get_input_timeout(self, prompt_chars):
+        with self.lock:
+            if len(self.input_rates) < self.min_samples:
+                return self.max_input_timeout
+            rate = get_quantile(self.input_rates, self.quantile)
+        timeout = rate * get_length_units(prompt_chars) * self.safety_factor * 2
+        return min(max(timeout, self.min_input_timeout), self.max_input_timeout)
+
+    def record_input(self, prompt_chars, seconds):
+        with self.lock:
+            self.input_rates.append(seconds / get_length_units(prompt_chars))
+
+    def record_response(self, prompt_chars, seconds, completed):
+        with self.lock:
+            if not completed:
+                # The deadline was too tight or the site is struggling: widen every deadline until it recovers
+                self.timed_out_responses += 1
+                self.backoff_factor = min(self.backoff_factor * self.backoff_multiplier, 10.0)
+                return
+            self.completed_responses += 1
+            rate = seconds / get_length_units(prompt_chars)
+            self.response_rates.append(rate)
+            if self.response_rate_ewma is None:
+                self.response_rate_ewma = rate
+            else:
+                self.response_rate_ewma += self.ewma_alpha * (rate - self.response_rate_ewma)
+            self.backoff_factor = max(1.0, self.backoff_factor / self.backoff_multiplier ** 0.5)
+
+    def get_summary(self):
+        with self.lock:
+            if not self.response_rates:
+                return f"Adaptive timing: no completed responses observed ({self.timed_out_responses} timed out)"
+            rate = get_quantile(self.response_rates, self.quantile)
+            return (
+                f"Adaptive timing: {self.completed_responses} completed / {self.timed_out_responses} timed out, "
+                f"mean {self.response_rate_ewma:.1f}s and p{self.quantile * 100:g} {rate:.1f}s per length unit (1 + prompt characters / {CHARS_PER_LENGTH_UNIT}), "
+                f"backoff x{self.backoff_factor:.2f}"
+            )
+
+def get_length_units(prompt_chars):
+    # Even an empty prompt takes one unit: most of the latency is the model starting up
+    return 1 + prompt_chars / CHARS_PER_LENGTH_UNIT
+
+def get_quantile(values, quantile):
+    ordered_values = sorted(values)
+    rank = max(1, math.ceil(quantile * len(ordered_values)))
+    return ordered_values[rank - 1]
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+from webdriver_manager.chrome import ChromeDriverManager
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+# Where the chromedriver resolved by ChromeDriverManager is remembered, so later runs skip the network lookup
+CHROMEDRIVER_PATH_CACHE = "~/.auto_securegpt/chromedriver_path"
+
+def resolve_chromedriver_path(chromedriver_path=None):
+    if chromedriver_path is not None:
+        return os.path.expanduser(chromedriver_path)
+
+    path_cache = os.path.expanduser(CHROMEDRIVER_PATH_CACHE)
+    if os.path.exists(path_cache):
+        with open(path_cache) as path_cache_file:
+            cached_chromedriver_path = path_cache_file.read().strip()
+        if os.path.exists(cached_chromedriver_path):
+            print(f"Using cached chromedriver: {cached_chromedriver_path}")
+            return cached_chromedriver_path
+
+    print(f"Resolving chromedriver with ChromeDriverManager")
+    chromedriver_path = ChromeDriverManager().install()
+    os.makedirs(os.path.dirname(path_cache), exist_ok=True)
+    with open(path_cache, 'w') as path_cache_file:
+        path_cache_file.write(chromedriver_path)
+    return chromedriver_path
+
+def build_chrome_options(headless=False, user_data_dir=None, lightweight_browser=False):
+    options = Options()
+    if headless:
+        options.add_argument('--headless=new')
+        options.add_argument('--window-size=1280,1024')
+    if user_data_dir is not None:
+        # A persisted profile keeps the SecureGPT login between runs
+        os.makedirs(user_data_dir, exist_ok=True)
+        options.add_argument(f'--user-data-dir={user_data_dir}')
+    if lightweight_browser:
+        # Images, web fonts and extensions aren't needed to read text responses
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--disable-remote-fonts')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--disable-background-networking')
+        options.add_argument('--disable-dev-shm-usage')
+        options.add_argument('--mute-audio')
+        options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.default_content_setting_values.notifications': 2,
+        })
+    return options
+
+def create_chrome_driver(chromedriver_path, headless=False, user_data_dir=None, lightweight_browser=False):
+    options = build_chrome_options(
+        headless=headless,
+        user_data_dir=user_data_dir,
+        lightweight_browser=lightweight_browser,
+        )
+    return webdriver.Chrome(service=Service(chromedriver_path), options=options)
+
+def get_worker_profile_dir(chrome_profile_dir, worker_id):
+    # Chrome locks a profile while it is open, so every concurrent session gets its own directory
+    if chrome_profile_dir is None:
+        return None
+    return os.path.join(os.path.expanduser(chrome_profile_dir), f"worker_{worker_id}")
+
+def load_session_cookies(driver, cookies_path, website_url):
+    # Cookies can only be set for the domain that is currently open
+    driver.get(website_url)
+    with open(cookies_path) as cookies_file:
+        cookies = json.load(cookies_file)
+    for cookie in cookies:
+        cookie.pop('sameSite', None)
+        try:
+            driver.add_cookie(cookie)
+        except WebDriverException as e:
+            print(f"Could not restore cookie '{cookie.get('name')}': {e.msg}")
+    driver.get(website_url)
+
+def save_session_cookies(driver, cookies_path):
+    os.makedirs(os.path.dirname(cookies_path) or '.', exist_ok=True)
+    with open(cookies_path, 'w') as cookies_file:
+        json.dump(driver.get_cookies(), cookies_file)
+    # The session cookies grant access to the account
+    os.chmod(cookies_path, 0o600)
+
+def wait_for_login(driver, timeout):
+    # The chat search bar only appears once the SecureGPT login has gone through
+    try:
+        WebDriverWait(driver, timeout).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, 'textarea.flex.w-full'))
+        )
+        return True
+    except TimeoutException:
+        return False
+
+def start_driver(
+        worker_id,
+        website_url,
+        chromedriver_path,
+        headless,
+        chrome_profile_dir,
+        cookies_path,
+        lightweight_browser,
+):
+    # Opens one session on the chat page. Also used to restart a session that stopped responding
+    driver = create_chrome_driver(
+        chromedriver_path=chromedriver_path,
+        headless=headless,
+        user_data_dir=get_worker_profile_dir(chrome_profile_dir, worker_id),
+        lightweight_browser=lightweight_browser,
+        )
+    print(f"Going to Website (session {worker_id})")
+    if cookies_path is not None and os.path.exists(cookies_path):
+        load_session_cookies(driver, cookies_path, website_url)
+    else:
+        driver.get(website_url)
+    return driver
+
+def start_logged_in_drivers(
+        workers,
+        website_url,
+        chromedriver_path,
+        headless,
+        chrome_profile_dir,
+        cookies_path,
+        lightweight_browser,
+        login_timeout,
+        manual_login_timeout=600,
+        session_labels=None,
+):
+    # session_labels names the GPT model each window should be set to, e.g. in a fan-out run
+    chromedriver_path = resolve_chromedriver_path(chromedriver_path)
+    cookies_path = os.path.expanduser(cookies_path) if cookies_path is not None else None
+    drivers = []
+    for worker_id in range(workers):
+        drivers.append(start_driver(
+            worker_id=worker_id,
+            website_url=website_url,
+            chromedriver_path=chromedriver_path,
+            headless=headless,
+            chrome_profile_dir=chrome_profile_dir,
+            cookies_path=cookies_path,
+            lightweight_browser=lightweight_browser,
+            ))
+
+    # A persisted profile or saved cookies can log the sessions in without anyone at the keyboard
+    logged_in = False
+    if chrome_profile_dir is not None or (cookies_path is not None and os.path.exists(cookies_path)):
+        print(f"Checking for an existing SecureGPT login")
+        logged_in = all(wait_for_login(driver, login_timeout) for driver in drivers)
+        if logged_in:
+            print(f"Existing SecureGPT login found. Proceeding...")
+
+    if not logged_in:
+        if session_labels is not None:
+            for worker_id, session_label in enumerate(session_labels):
+                print(f"Chrome window {worker_id + 1}: select {session_label}")
+        if headless:
+            for driver in drivers:
+                driver.quit()
+            raise RuntimeError("No SecureGPT login found for the headless browser. Run once without --headless using the same --chrome_profile_dir/--cookies_path to log in.")
+        if not sys.stdin.isatty():
+            # Nobody can answer a prompt (nohup, cron, a scheduler), so wait for the login to show up instead
+            print(f"\nPlease log into SecureGPT in each of the {workers} Chrome window(s). Waiting up to {manual_login_timeout}s for the chat page...")
+            if not all(wait_for_login(driver, manual_login_timeout) for driver in drivers):
+                for driver in drivers:
+                    driver.quit()
+                raise RuntimeError(f"No SecureGPT login within {manual_login_timeout}s")
+            print("Login found. Proceeding...")
+        else:
+            # Loop until the user inputs '1'
+            user_input = ""
+            while user_input != "1":
+                user_input = input(f"\nPlease set-up the GPT environment in each of the {workers} Chrome window(s) by fully logging into SecureGPT and opening a new chat window. Select your preferred GPT (GPT-3.5 vs. GPT-4) and conversation style (Creative vs. Balanced vs. Precise). Press 'Enter' after typing '1' to proceed: ")
+                if user_input == "1":
+                    print("Proceeding...")
+                else:
+                    print("Incorrect input. Please type '1' to proceed: ")
+
+    if cookies_path is not None:
+        save_session_cookies(drivers[0], cookies_path)
+        print(f"Session cookies saved to {cookies_path}")
+    return drivers
@@ -0,0 +1,141 @@
+import re
+import time
+
+from selenium.common.exceptions import WebDriverException
+
+from helper_functions import send_data_and_get_output, PageStalledError
+from chat_session import ChatSession
+from run_telemetry import NULL_TELEMETRY
+
+class RateLimiter:
+    # Enforces a minimum interval between two messages (prompts, resends, disclaimers) sent from the same chat session
+    def __init__(self, min_seconds_between_prompts, initial_delay_seconds=0):
+        self.min_seconds_between_prompts = min_seconds_between_prompts
+        self.initial_delay_seconds = initial_delay_seconds
+        self.last_send_time = None
+
+    def wait(self, telemetry=NULL_TELEMETRY):
+        if self.last_send_time is None:
+            remaining = self.initial_delay_seconds
+        else:
+            remaining = self.min_seconds_between_prompts - (time.monotonic() - self.last_send_time)
+        if remaining > 0:
+            with telemetry.span('rate_limit'):
+                time.sleep(remaining)
+        self.last_send_time = time.monotonic()
+
+class ChatBackend:
+    # One chat session the scheduler can hand prompts to. send_prompt runs the whole
+    # send/wait/extract/validate cycle for one prompt and returns (latest_output, latest_send).
+    # It is called from a worker thread, never concurrently for the same backend. configuration is
+    # the ChatConfiguration the session answers for in a fan-out run, None otherwise
+    def __init__(self, name, configuration=None):
+        self.name = name
+        self.configuration = configuration
+
+    def send_prompt(self, prompt):
+        raise NotImplementedError
+
+    def discard_chat(self):
+        # Called after a rejected output, so the next prompt doesn't start in a chat holding the
+        # refusal or a response that is still generating
+        pass
+
+    def close(self):
+        pass
+
+class SeleniumBackend(ChatBackend):
+    # Drives the SecureGPT web UI in one Chrome session. Chat rotation, the disclaimer and content
+    # moderation checks only ever look at what was sent through this session
+    def __init__(
+            self,
+            name,
+            driver,
+            min_seconds_between_prompts=0,
+            initial_delay_seconds=0,
+            max_chat_dialogs=5,
+            max_transcript_chars=None,
+            disclaimer_statement=None,
+            disclaimer_mode='separate',
+            conversation_style='Balanced',
+            recovery=None,
+            configuration=None,
+            **send_kwargs,
+    ):
+        super().__init__(name, configuration)
+        self.driver = driver
+        self.chat_session = ChatSession(
+            driver=driver,
+            rate_limiter=RateLimiter(min_seconds_between_prompts, initial_delay_seconds),
+            max_chat_dialogs=max_chat_dialogs,
+            max_transcript_chars=max_transcript_chars,
+            disclaimer_statement=disclaimer_statement,
+            disclaimer_mode=disclaimer_mode,
+            conversation_style=configuration.conversation_style if configuration is not None else conversation_style,
+            )
+        if configuration is not None:
+            # The style is picked by the bot in a new chat rather than trusted to the hand setup
+            self.chat_session.request_new_chat()
+        # A SessionRecovery, or None to let page errors end the run as before
+        self.recovery = recovery
+        self.send_kwargs = send_kwargs
+        self.global_iteration = 0 # Counts prompts actually sent through this session
+        self.last_send_with_recorded_output = None
+
+    def send_prompt(self, prompt):
+        self.global_iteration += 1
+        failure_count = 0
+        while True:
+            try:
+                latest_output, latest_send = send_data_and_get_output(
+                    driver=self.driver,
+                    prompt=prompt,
+                    chat_session=self.chat_session,
+                    global_iteration=self.global_iteration,
+                    last_send_with_recorded_output=self.last_send_with_recorded_output,
+                    **self.send_kwargs,
+                    )
+                break
+            except (PageStalledError, WebDriverException) as e:
+                if self.recovery is None:
+                    raise
+                failure_count += 1
+                # Raises SessionLostError once every recovery step has been tried
+                self.recovery.recover(backend=self, failure_count=failure_count, error=e)
+        if latest_output != 'NA':
+            # Kept as it appears on the page, prepended disclaimer included, for the moderation check
+            self.last_send_with_recorded_output = latest_send
+        return latest_output, self.chat_session.strip_prompt_prefix(latest_send)
+
+    def discard_chat(self):
+        self.chat_session.request_new_chat()
+
+    def replace_driver(self, driver):
+        self.driver = driver
+        self.chat_session.replace_driver(driver)
+        self.last_send_with_recorded_output = None
+
+    def close(self):
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass # The browser already went away
+
+class StubBackend(ChatBackend):
+    # Answers locally without a browser, for dry runs and for testing the orchestration
+    def __init__(self, name, latency_seconds=0, response_template="Stub response to: {prompt}", configuration=None):
+        super().__init__(name, configuration)
+        self.latency_seconds = latency_seconds
+        self.response_template = response_template
+
+    def send_prompt(self, prompt):
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+        processed_data = prompt.replace('\n', ' ')
+        # Batched prompts get one numbered answer per prompt, like a model following the batch instruction
+        prompt_parts = re.split(r'### PROMPT (\d+) ###', processed_data)
+        if len(prompt_parts) > 1:
+            numbered_prompts = zip(prompt_parts[1::2], prompt_parts[2::2])
+            response = ' '.join(f"### ANSWER {prompt_number} ### {self.response_template.format(prompt=part.strip())}" for prompt_number, part in numbered_prompts)
+            return response, processed_data
+        return self.response_template.format(prompt=processed_data), processed_data
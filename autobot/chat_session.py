@@ -0,0 +1,112 @@
+from run_telemetry import NULL_TELEMETRY
+from helper_functions import click_new_chat_button, click_conversation_style_button, wait_for_new_chat_ready, send_disclaimer_statement, clean_processed_data
+
+# 'separate' spends one generation per chat on the disclaimer, 'prepend' puts it in front of the chat's first prompt
+DISCLAIMER_MODES = ['separate', 'prepend']
+
+class ChatSession:
+    # Tracks the chat window one browser session is typing into. Prompts and transcript characters are
+    # counted as they are sent, so deciding when to rotate never re-scans the page. Rotation is lazy: a
+    # full chat is only replaced right before the next prompt, so no chat is opened that won't be used
+    def __init__(
+            self,
+            driver,
+            max_chat_dialogs,
+            max_transcript_chars=None,
+            disclaimer_statement=None,
+            disclaimer_mode='separate',
+            conversation_style='Balanced',
+            new_chat_timeout=15,
+            rate_limiter=None,
+    ):
+        if disclaimer_mode not in DISCLAIMER_MODES:
+            raise ValueError(f"Unknown disclaimer mode '{disclaimer_mode}'. Choose from {DISCLAIMER_MODES}")
+        self.driver = driver
+        self.max_chat_dialogs = max_chat_dialogs
+        self.max_transcript_chars = max_transcript_chars
+        self.disclaimer_statement = disclaimer_statement
+        self.disclaimer_mode = disclaimer_mode
+        self.conversation_style = conversation_style
+        self.new_chat_timeout = new_chat_timeout
+        # Spaces out every message this session sends: prompts, resends and disclaimers alike
+        self.rate_limiter = rate_limiter
+        # The first chat is opened by hand during the browser setup
+        self.new_chat_requested = False
+        self.prompts_in_chat = 0
+        self.transcript_chars = 0
+        self.disclaimer_sent = False
+        self.last_prompt_prefix = ''
+        self.chats_opened = 0
+
+    def needs_new_chat(self):
+        if self.new_chat_requested or self.prompts_in_chat >= self.max_chat_dialogs:
+            return True
+        return self.max_transcript_chars is not None and self.transcript_chars >= self.max_transcript_chars
+
+    def replace_driver(self, driver):
+        # After a browser restart: the chat the new browser lands on isn't known, so a fresh one is opened
+        self.driver = driver
+        self.request_new_chat()
+
+    def request_new_chat(self):
+        # The next prompt goes to a fresh chat, e.g. to resend a rejected output
+        self.new_chat_requested = True
+
+    def open_new_chat(self, telemetry=NULL_TELEMETRY):
+        print("\n\nCreating new chat window...")
+        with telemetry.span('new_chat'):
+            click_new_chat_button(driver=self.driver)
+            # Returns as soon as the old transcript is gone and the search bar is back
+            wait_for_new_chat_ready(driver=self.driver, timeout=self.new_chat_timeout)
+            click_conversation_style_button(driver=self.driver, conversation_style=self.conversation_style, timeout=self.new_chat_timeout)
+            print("New chat window created\n\n")
+        self.new_chat_requested = False
+        self.prompts_in_chat = 0
+        self.transcript_chars = 0
+        self.disclaimer_sent = False
+        self.chats_opened += 1
+
+    def prepare_prompt(self, processed_data, generation_sleep_timer, input_strategy='javascript', telemetry=NULL_TELEMETRY, timing_controller=None):
+        # Rotates the chat if it is full and handles its disclaimer. Returns the text to send, which
+        # the caller sends straight away
+        if self.needs_new_chat():
+            self.open_new_chat(telemetry=telemetry)
+        self.last_prompt_prefix = ''
+        if self.disclaimer_statement is None or self.disclaimer_sent or self.prompts_in_chat > 0:
+            self.wait_for_send_slot(telemetry=telemetry)
+            return processed_data
+        if self.disclaimer_mode == 'prepend':
+            self.last_prompt_prefix = self.disclaimer_statement.replace('\n', ' ') + ' '
+        else:
+            self.wait_for_send_slot(telemetry=telemetry)
+            send_disclaimer_statement(
+                driver=self.driver,
+                disclaimer_statement=self.disclaimer_statement,
+                generation_sleep_timer=generation_sleep_timer,
+                input_strategy=input_strategy,
+                telemetry=telemetry,
+                timing_controller=timing_controller,
+                )
+            self.transcript_chars += len(self.disclaimer_statement)
+        self.disclaimer_sent = True
+        self.wait_for_send_slot(telemetry=telemetry)
+        return self.last_prompt_prefix + processed_data
+
+    def wait_for_send_slot(self, telemetry=NULL_TELEMETRY):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(telemetry=telemetry)
+
+    def record_exchange(self, sent_chars, output_chars):
+        self.prompts_in_chat += 1
+        self.transcript_chars += sent_chars + output_chars
+
+    def strip_prompt_prefix(self, latest_send):
+        # The prompt as recorded in the output file, without a prepended disclaimer
+        if not self.last_prompt_prefix:
+            return latest_send
+        # The page may re-wrap the text, so compare with whitespace normalized
+        cleaned_send = clean_processed_data(latest_send)
+        cleaned_prefix = clean_processed_data(self.last_prompt_prefix)
+        if cleaned_send.startswith(cleaned_prefix):
+            return cleaned_send[len(cleaned_prefix):].strip()
+        return latest_send
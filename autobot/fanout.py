@@ -0,0 +1,95 @@
+import re
+import pandas as pd
+
+from output_postprocessing import postprocess_results, get_input_prompt_column
+
+class ChatConfiguration:
+    # One model/style pair of a fan-out run. Each configuration gets its own browser session(s) and
+    # its own output column
+    def __init__(self, gpt_model, conversation_style):
+        self.gpt_model = gpt_model
+        self.conversation_style = conversation_style
+        self.name = re.sub(r'[^0-9a-z]+', '_', f"{gpt_model}_{conversation_style}".lower()).strip('_')
+
+    def __repr__(self):
+        return f"{self.gpt_model}:{self.conversation_style}"
+
+def parse_configurations(configurations_spec):
+    # 'GPT-4:Balanced, GPT-3.5:Precise' -> one ChatConfiguration per pair
+    configurations = []
+    for configuration_spec in configurations_spec.split(','):
+        if not configuration_spec.strip():
+            continue
+        gpt_model, separator, conversation_style = configuration_spec.partition(':')
+        if not separator or not gpt_model.strip() or not conversation_style.strip():
+            raise ValueError(f"Configuration '{configuration_spec.strip()}' should look like '<gpt_model>:<conversation_style>'")
+        configurations.append(ChatConfiguration(gpt_model.strip(), conversation_style.strip()))
+    if not configurations:
+        raise ValueError(f"No configurations found in '{configurations_spec}'")
+    configuration_names = [configuration.name for configuration in configurations]
+    if len(set(configuration_names)) != len(configuration_names):
+        raise ValueError(f"Configurations must be distinct, got {configurations}")
+    return configurations
+
+def expand_configurations(chunk, configurations):
+    # One task row per input row and configuration. prompt_id becomes '<prompt_id>@<configuration>', so
+    # the run journal, the result sink and the retry bookkeeping track every configuration of a prompt
+    # on its own; source_prompt_id keeps the input's id. Tasks are grouped by configuration within the
+    # chunk, so a batch never mixes configurations
+    task_chunks = [
+        chunk.assign(
+            source_prompt_id=chunk['prompt_id'],
+            configuration=configuration.name,
+            prompt_id=chunk['prompt_id'].astype(str) + '@' + configuration.name,
+            )
+        for configuration in configurations
+    ]
+    return pd.concat(task_chunks, ignore_index=True)
+
+def get_configuration_output_column(output_column_name, configuration):
+    return f"{output_column_name}_{configuration.name}"
+
+def pivot_configuration_results(results_df, input_column_names, output_column_name, configurations):
+    # Task rows (one per prompt and configuration) -> one row per prompt with an output column per
+    # configuration. The prompt column holds the prompt as sent by the first configuration that answered
+    output_column_names = [get_configuration_output_column(output_column_name, configuration) for configuration in configurations]
+    if results_df.empty:
+        return pd.DataFrame(columns=input_column_names + output_column_names)
+    results_df = results_df.assign(prompt_id=results_df['source_prompt_id'])
+    outputs = results_df.pivot(index='prompt_id', columns='configuration', values=output_column_name)
+    outputs = outputs.reindex(columns=[configuration.name for configuration in configurations])
+    outputs.columns = output_column_names
+    prompts = results_df.drop_duplicates(subset='prompt_id').set_index('prompt_id')
+    prompts = prompts[[column for column in input_column_names if column != 'prompt_id']]
+    wide_results = prompts.join(outputs).sort_index().reset_index()
+    return wide_results.reindex(columns=input_column_names + output_column_names)
+
+def assemble_results(
+        result_sink,
+        final_path,
+        input_column_names,
+        prompt_column_name,
+        output_column_name,
+        configurations=None,
+        lowercase_output=False,
+        keep_raw_output=False,
+):
+    # Builds the final output file from the outputs as captured. They are normalized and flagged in one
+    # pass over the whole run; a fan-out run is then pivoted to one row per prompt (the flags are only
+    # kept in a plain run's file). Returns the quality stats of the outputs
+    results_df = result_sink.to_dataframe()
+    processed_df, quality_stats = postprocess_results(
+        results_df=results_df,
+        prompt_column_name=prompt_column_name,
+        output_column_name=output_column_name,
+        lowercase_output=lowercase_output,
+        keep_raw_output=keep_raw_output and configurations is None,
+        group_column_name='configuration' if configurations is not None else None,
+        input_prompt_column_name=get_input_prompt_column(prompt_column_name),
+        )
+    # The input prompts are only kept in the results for the check above
+    processed_df = processed_df.drop(columns=[get_input_prompt_column(prompt_column_name)], errors='ignore')
+    if configurations is not None:
+        processed_df = pivot_configuration_results(processed_df, input_column_names, output_column_name, configurations)
+    processed_df.to_csv(final_path, index=False)
+    return quality_stats
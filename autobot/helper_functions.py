@@ -6,18 +6,63 @@ import argparse
 import glob
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import WebDriverWait
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException, NoSuchElementException, StaleElementReferenceException, WebDriverException
 import pandas as pd
 import time
 import pyperclip
 from datetime import datetime
 import pytz
 
+from run_telemetry import NULL_TELEMETRY
+from output_postprocessing import strip_output_header
+
+OUTPUT_CONTAINER_CLASSES = 'container mx-auto max-w-4xl py-6 flex flex-col items-start'
+SEND_CONTAINER_CLASSES = 'container mx-auto max-w-4xl py-6 flex flex-col items-end'
+# Returns the newest output/send pair plus the page state in one call. The live HTMLCollections are
+# cached on window and track the transcript as it grows, so the transcript is never re-queried
+GET_LATEST_DIALOG_SCRIPT = """
+if (!window.autoSecureGptDialogs) {
+    window.autoSecureGptDialogs = {
+        outputs: document.getElementsByClassName(arguments[0]),
+        sends: document.getElementsByClassName(arguments[1]),
+    };
+}
+const dialogs = window.autoSecureGptDialogs;
+const latestOutput = dialogs.outputs[dialogs.outputs.length - 1];
+const latestSend = dialogs.sends[dialogs.sends.length - 1];
+return {
+    output_text: latestOutput ? latestOutput.innerText : '',
+    send_text: latestSend ? latestSend.innerText : '',
+    output_count: dialogs.outputs.length,
+    send_count: dialogs.sends.length,
+    loading: document.querySelector('.lucide.lucide-loader.animate-spin') !== null,
+    send_button_present: document.querySelector("button[type='submit'] svg.lucide.lucide-send") !== null,
+    toast_present: document.querySelector('button[toast-close]') !== null,
+    page_timestamp: Date.now() / 1000,
+};
+"""
+
+class PageStalledError(Exception):
+    # Raised by the response wait when the page shows no progress at all for stall_timeout seconds
+    pass
+
+# Ways of filling the search bar, fastest first. Each one falls back to the next if the text doesn't land
+INPUT_STRATEGIES = ['javascript', 'clipboard', 'keystrokes']
+SET_SEARCH_BAR_VALUE_SCRIPT = """
+const searchBar = arguments[0];
+// React tracks the value through the native setter, so assigning searchBar.value directly is ignored
+const setNativeValue = Object.getOwnPropertyDescriptor(window.HTMLTextAreaElement.prototype, 'value').set;
+setNativeValue.call(searchBar, arguments[1]);
+searchBar.dispatchEvent(new Event('input', { bubbles: true }));
+searchBar.dispatchEvent(new Event('change', { bubbles: true }));
+"""
+
 def send_data_and_get_output(
         driver,
         prompt, 
@@ -25,75 +70,71 @@ def send_data_and_get_output(
         generation_sleep_timer,
         max_data_loading_retries,
         retry_data_loading_wait_time,
-        max_chat_dialogs,
+        chat_session,
         global_iteration,
-        total_iterations,
-        llm_output,
-        prompt_column_name,
-        output_column_name,
-        disclaimer_statement,
-        terms_to_avoid,
-        min_output_word_count,
+        last_send_with_recorded_output,
+        output_validator,
+        input_strategy='javascript',
+        telemetry=NULL_TELEMETRY,
+        timing_controller=None,
+        max_resends=None,
+        stall_timeout=None,
 ):
-    if global_iteration == 1 and disclaimer_statement is not None:
-        print(f"Sending disclaimer statement")
-        search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full')
-        search_bar.clear()
-        search_bar.send_keys(disclaimer_statement)
-        time.sleep(5)
-        click_send_data_button(driver)
-        time.sleep(generation_sleep_timer)
-
-    search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full') # Find the search bar
-    search_bar.clear()  # Clearing the search bar before sending new data
+    # chat_session (a ChatSession) decides when to open a new chat window and sends the disclaimer
     processed_data = prompt.replace('\n', ' ') # Remove or replace newline characters, then add a newline at the end
-    search_bar.send_keys(processed_data) # Send the data to the search bar
-    time.sleep(input_text_lag_time) # Wait for input to be sent to search bar
-    click_send_data_button(driver) # Click send data button
-    time.sleep(generation_sleep_timer) # Wait for the output to be displayed
-
-    retries = 0
-    while is_loading_present(driver) and retries < max_data_loading_retries:
-        retries += 1
-        print(f"Count {retries}: Waiting for data to load...")
-        time.sleep(retry_data_loading_wait_time)
-
-    # Find all elements that match the output structure
-    elements_start = driver.find_elements(By.XPATH, "//*[contains(@class, 'container mx-auto max-w-4xl py-6 flex flex-col items-start')]")
-    elements_end = driver.find_elements(By.XPATH, "//*[contains(@class, 'container mx-auto max-w-4xl py-6 flex flex-col items-end')]")
-
-    if retries < max_data_loading_retries:        
-        # Assuming the newest output is always last, get the last element's text and dialog sent
-        latest_output = elements_start[-1].text.replace('Secure GPT (Beta)\n', '').replace('\n', ' ').lower()
-        user_contained_text = elements_end[-1].text
-        latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
-        word_count = len(latest_output.split())
-        
-        if global_iteration != 1:
-            # Validate latest_output for content moderation failure
-            latest_output, latest_send = validate_latest_dialog_sent(
-                latest_output=latest_output, 
-                latest_send=latest_send, 
-                llm_output=llm_output, 
-                prompt_column_name=prompt_column_name, 
-                output_column_name=output_column_name, 
-                processed_data=processed_data
-                )
-    elif retries >= max_data_loading_retries:
-        print(f"Data loading retries exceeded. Setting output as 'DATA_LOAD_FAILURE'")
-        latest_output = "DATA_LOAD_FAILURE"
-        user_contained_text = elements_end[-1].text
-        latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
-        word_count = len(latest_output.split()) # recalculating word count for 'DATA_LOAD_FAILURE' to initiate check_for_terms_and_resend_data_if_needed() loop
-    
-    print(f"Checking LLM Output for terms to avoid...")
-    latest_output, latest_send, word_count = check_for_terms_and_resend_data_if_needed(
+    processed_data = chat_session.prepare_prompt(
+        processed_data=processed_data,
+        generation_sleep_timer=generation_sleep_timer,
+        input_strategy=input_strategy,
+        telemetry=telemetry,
+        timing_controller=timing_controller,
+        )
+    response_completed = send_prompt_and_wait_for_response(
+        driver=driver,
+        processed_data=processed_data,
+        input_text_lag_time=input_text_lag_time,
+        generation_sleep_timer=generation_sleep_timer,
+        max_data_loading_retries=max_data_loading_retries,
+        retry_data_loading_wait_time=retry_data_loading_wait_time,
+        input_strategy=input_strategy,
+        telemetry=telemetry,
+        timing_controller=timing_controller,
+        stall_timeout=stall_timeout,
+        )
+
+    with telemetry.span('extraction'):
+        # Fetch the newest output/send pair in a single round-trip
+        latest_dialog = get_latest_dialog(driver)
+
+        if response_completed:
+            # Assuming the newest output is always last, get the last element's text and dialog sent.
+            # The text is kept as captured (case and line breaks included); it is normalized once for the
+            # whole run by the post-processing stage
+            latest_output = strip_output_header(latest_dialog['output_text'])
+            user_contained_text = latest_dialog['send_text']
+            latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
+
+            if global_iteration != 1:
+                # Validate latest_output for content moderation failure
+                latest_output, latest_send = validate_latest_dialog_sent(
+                    latest_output=latest_output, 
+                    latest_send=latest_send, 
+                    last_send_with_recorded_output=last_send_with_recorded_output, 
+                    processed_data=processed_data
+                    )
+        else:
+            print(f"Data loading retries exceeded. Setting output as 'DATA_LOAD_FAILURE'")
+            latest_output = "DATA_LOAD_FAILURE"
+            user_contained_text = latest_dialog['send_text']
+            latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
+        chat_session.record_exchange(sent_chars=len(processed_data), output_chars=len(latest_dialog['output_text']))
+
+    print(f"Checking LLM Output against the validation rules...")
+    latest_output, latest_send = check_for_terms_and_resend_data_if_needed(
         latest_output=latest_output,
         latest_send=latest_send,
-        disclaimer_statement=disclaimer_statement,
-        terms_to_avoid=terms_to_avoid,
-        min_output_word_count=min_output_word_count,
-        word_count=word_count,
+        chat_session=chat_session,
+        output_validator=output_validator,
         driver=driver,
         prompt=prompt, 
         input_text_lag_time=input_text_lag_time,
@@ -101,48 +142,22 @@ def send_data_and_get_output(
         max_data_loading_retries=max_data_loading_retries,
         retry_data_loading_wait_time=retry_data_loading_wait_time,
         global_iteration=global_iteration,
-        llm_output=llm_output,
-        prompt_column_name=prompt_column_name,
-        output_column_name=output_column_name,
+        last_send_with_recorded_output=last_send_with_recorded_output,
+        input_strategy=input_strategy,
+        telemetry=telemetry,
+        timing_controller=timing_controller,
+        max_resends=max_resends,
+        stall_timeout=stall_timeout,
         )
     print(f"LLM Output:\n{latest_output}")
 
-    # # validate latest_output:
-    # latest_output = validate_output_text(latest_output)
-
-    # Create new chat window (if statement)
-    if disclaimer_statement is not None:
-        total_outputs = len(elements_start)-1
-    else:
-        total_outputs = len(elements_start)
-    if total_outputs % max_chat_dialogs == 0 and global_iteration != total_iterations:
-            print("\n\nCreating new chat window...")
-            click_new_chat_button(driver=driver)
-            time.sleep(3)
-            click_balanced_button(driver=driver)
-            # time.sleep(3)
-            # click_file_button(driver=driver)
-            print("New chat window created\n\n")
-            time.sleep(5)
-
-            if disclaimer_statement is not None:
-                print(f"Sending disclaimer statement")
-                search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full')
-                search_bar.clear()
-                search_bar.send_keys(disclaimer_statement)
-                time.sleep(5)
-                click_send_data_button(driver)
-                time.sleep(generation_sleep_timer)
-
     return latest_output, latest_send
 
 def check_for_terms_and_resend_data_if_needed(
         latest_output,
         latest_send,
-        disclaimer_statement,
-        terms_to_avoid,
-        min_output_word_count,
-        word_count,
+        chat_session,
+        output_validator,
         driver,
         prompt,
         input_text_lag_time,
@@ -150,99 +165,94 @@ def check_for_terms_and_resend_data_if_needed(
         max_data_loading_retries,
         retry_data_loading_wait_time,
         global_iteration,
-        llm_output,
-        prompt_column_name,
-        output_column_name,
+        last_send_with_recorded_output,
+        input_strategy='javascript',
+        telemetry=NULL_TELEMETRY,
+        timing_controller=None,
+        max_resends=None,
+        stall_timeout=None,
 ):
+    # The same output_validator as the run's retry policy (terms to avoid, --validation_rules_path rules,
+    # minimum word count), so an output resent here is one the retry policy would reject too
+    attempt = 1
     while True:
-        # Check conditions
-        contains_forbidden_terms = any(term.lower() in latest_output.lower() for term in terms_to_avoid)
-        below_min_word_count = word_count <= min_output_word_count
-
-        if not contains_forbidden_terms and not below_min_word_count:
+        validation_result = output_validator.validate(latest_output)
+        if validation_result is None:
             break  # Exit loop if output is acceptable
 
-        # Debug printouts to identify the cause of the reiteration
-        if contains_forbidden_terms:
-            print("Output contains forbidden terms.")
-        if below_min_word_count:
-            print("Output is below the minimum word count.")
-
         # Inform about the inference error with specifics
-        print(f"LLM Inference Error:\n{latest_output}\nWord Count: {word_count}\nForbidden Terms Present: {contains_forbidden_terms}")
+        rule_name, detail = validation_result
+        print(f"LLM Inference Error:\n{latest_output}\nRejected by {rule_name}: {detail}")
 
-        # Reset process
-        print("\n\nCreating new chat window...")
-        click_new_chat_button(driver=driver)
-        time.sleep(3)
-        click_balanced_button(driver=driver)
-        print("New chat window created\n\n")
-        time.sleep(5)
+        if max_resends is not None and attempt > max_resends:
+            # Left to the caller's retry policy, which defers the row instead of blocking this session
+            print(f"Resend limit of {max_resends} reached. Returning the rejected output")
+            break
 
-        print(f"\nSending disclaimer statement")
-        search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full')
-        search_bar.clear()
-        search_bar.send_keys(disclaimer_statement)
-        time.sleep(5)
-        click_send_data_button(driver)
-        time.sleep(generation_sleep_timer)
+        attempt += 1
+        telemetry.set_attempt(attempt)
 
-        # Resend data process
-        search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full')
-        search_bar.clear()
-        processed_data = prompt.replace('\n', ' ')
-        search_bar.send_keys(processed_data)
-        time.sleep(input_text_lag_time)
-        click_send_data_button(driver)
-        time.sleep(generation_sleep_timer)
-
-        retries = 0
-        while is_loading_present(driver) and retries < max_data_loading_retries:
-            retries += 1
-            print(f"Count {retries}: Waiting for data to load...")
-            time.sleep(retry_data_loading_wait_time)
-
-        # Find all elements that match the output structure
-        elements_start = driver.find_elements(By.XPATH, "//*[contains(@class, 'container mx-auto max-w-4xl py-6 flex flex-col items-start')]")
-        elements_end = driver.find_elements(By.XPATH, "//*[contains(@class, 'container mx-auto max-w-4xl py-6 flex flex-col items-end')]")
-
-        if retries < max_data_loading_retries:        
-            # Assuming the newest output is always last, get the last element's text and dialog sent
-            latest_output = elements_start[-1].text.replace('Secure GPT (Beta)\n', '').replace('\n', ' ').lower()
-            user_contained_text = elements_end[-1].text
-            latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
-            word_count = len(latest_output.split())
+        # Resend the prompt in a new chat window
+        chat_session.request_new_chat()
+        processed_data = chat_session.prepare_prompt(
+            processed_data=prompt.replace('\n', ' '),
+            generation_sleep_timer=generation_sleep_timer,
+            input_strategy=input_strategy,
+            telemetry=telemetry,
+            timing_controller=timing_controller,
+            )
+        response_completed = send_prompt_and_wait_for_response(
+            driver=driver,
+            processed_data=processed_data,
+            input_text_lag_time=input_text_lag_time,
+            generation_sleep_timer=generation_sleep_timer,
+            max_data_loading_retries=max_data_loading_retries,
+            retry_data_loading_wait_time=retry_data_loading_wait_time,
+            input_strategy=input_strategy,
+            telemetry=telemetry,
+            timing_controller=timing_controller,
+            stall_timeout=stall_timeout,
+            )
 
-            if global_iteration != 1:
-                # Validate latest_output for content moderation failure
-                latest_output, latest_send = validate_latest_dialog_sent(
-                    latest_output=latest_output, 
-                    latest_send=latest_send, 
-                    llm_output=llm_output, 
-                    prompt_column_name=prompt_column_name, 
-                    output_column_name=output_column_name, 
-                    processed_data=processed_data
-                    )
-        elif retries >= max_data_loading_retries:
-            print(f"Data loading retries exceeded. Setting output as 'DATA_LOAD_FAILURE'")
-            latest_output = "DATA_LOAD_FAILURE"
-            user_contained_text = elements_end[-1].text
-            latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
-            word_count = len(latest_output.split()) # recalculating word count for 'DATA_LOAD_FAILURE' to initiate check_for_terms_and_resend_data_if_needed() loop
+        with telemetry.span('extraction'):
+            # Fetch the newest output/send pair in a single round-trip
+            latest_dialog = get_latest_dialog(driver)
 
-    return latest_output, latest_send, word_count
+            if response_completed:
+                # Assuming the newest output is always last, get the last element's text and dialog sent
+                latest_output = strip_output_header(latest_dialog['output_text'])
+                user_contained_text = latest_dialog['send_text']
+                latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
+
+                if global_iteration != 1:
+                    # Validate latest_output for content moderation failure
+                    latest_output, latest_send = validate_latest_dialog_sent(
+                        latest_output=latest_output, 
+                        latest_send=latest_send, 
+                        last_send_with_recorded_output=last_send_with_recorded_output, 
+                        processed_data=processed_data
+                        )
+            else:
+                print(f"Data loading retries exceeded. Setting output as 'DATA_LOAD_FAILURE'")
+                latest_output = "DATA_LOAD_FAILURE"
+                user_contained_text = latest_dialog['send_text']
+                latest_send = re.sub(r'.*\s\(SU\)\n', '', user_contained_text)
+        chat_session.record_exchange(sent_chars=len(processed_data), output_chars=len(latest_dialog['output_text']))
+
+    return latest_output, latest_send
 
 def validate_latest_dialog_sent(
         latest_output,
         latest_send,
-        llm_output,
-        prompt_column_name,
-        output_column_name,
+        last_send_with_recorded_output,
         processed_data,
 ):
-    # Checking last recorded dialog and latest dialog sent for content moderation failure
-    last_send_with_recorded_output = llm_output[llm_output[output_column_name] != 'NA'][prompt_column_name].iloc[-1]
-    
+    # Checking last recorded dialog and latest dialog sent for content moderation failure.
+    # last_send_with_recorded_output is the last dialog recorded with an output other than 'NA'
+    # in this browser session (None until one has been recorded)
+    if last_send_with_recorded_output is None:
+        return latest_output, latest_send
+
     # Check if the latest dialog sent matches the last recorded dialog
     if last_send_with_recorded_output == latest_send:
         # Now check if this duplication is unexpected (i.e., not just repeating processed_data)
@@ -254,11 +264,20 @@ def validate_latest_dialog_sent(
     # Always return latest_output and latest_send, potentially adjusted
     return latest_output, latest_send
 
-def click_balanced_button(driver):
-    # Assuming 'Balanced' is unique text on the button
-    balanced_button_xpath = "//button[contains(., 'Balanced')]"
-    balanced_button = driver.find_element(By.XPATH, balanced_button_xpath)
-    balanced_button.click()
+def click_balanced_button(driver, timeout=0):
+    click_conversation_style_button(driver=driver, conversation_style='Balanced', timeout=timeout)
+
+def click_conversation_style_button(driver, conversation_style, timeout=0):
+    # Assuming the style name ('Creative', 'Balanced', 'Precise') is unique text on the button
+    style_button_xpath = f"//button[contains(., '{conversation_style}')]"
+    if timeout > 0:
+        # Waits for the button to be clickable instead of sleeping a fixed time after a new chat
+        style_button = WebDriverWait(driver, timeout, poll_frequency=0.2).until(
+            EC.element_to_be_clickable((By.XPATH, style_button_xpath))
+        )
+    else:
+        style_button = driver.find_element(By.XPATH, style_button_xpath)
+    style_button.click()
 
 def click_new_chat_button(driver):
     # Specific CSS selector targeting the parent div and then the button
@@ -267,21 +286,18 @@ def click_new_chat_button(driver):
     specific_button = driver.find_element(By.CSS_SELECTOR, specific_button_css_selector)
     specific_button.click()
 
-def attempt_send_action(driver):
-    if not click_send_data_button(driver):
-        # If clicking the send button fails, try to close the notification box
-        if close_notification_box(driver):
-            # If successfully closed the notification, try clicking the send button again
-            click_send_data_button(driver)
-        else:
-            # If could not close the notification, wait for user input to proceed
-            print("Could not handle the notification box; further action might be needed.")
-            user_input = input("Please fix the issue and type 1 to continue: ")
-            if user_input == "1":
-                # Try clicking the send button again after the user indicates the problem is fixed
-                click_send_data_button(driver)
-            else:
-                print("Incorrect input. Exiting the function.")
+def attempt_send_action(driver, toast_present=False):
+    # A visible notification box blocks sending, so it is closed first. If the send button still
+    # can't be clicked the error is raised for the session's recovery ladder instead of waiting on input()
+    if toast_present:
+        close_notification_box(driver)
+    try:
+        click_send_data_button(driver)
+    except WebDriverException:
+        # If clicking the send button fails, try to close the notification box and click again
+        if not close_notification_box(driver):
+            raise
+        click_send_data_button(driver)
 
 def close_notification_box(driver):
     try:
@@ -302,14 +318,202 @@ def click_send_data_button(driver):
     send_button = driver.find_element(By.CSS_SELECTOR, send_button_css_selector)
     send_button.click()
 
-def is_loading_present(driver):
+def send_disclaimer_statement(driver, disclaimer_statement, generation_sleep_timer, input_strategy='javascript', telemetry=NULL_TELEMETRY, timing_controller=None):
+    print(f"Sending disclaimer statement")
+    with telemetry.span('disclaimer_input'):
+        search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full')
+        enter_search_bar_text(driver=driver, search_bar=search_bar, text=disclaimer_statement, timeout=5, input_strategy=input_strategy)
+        latest_dialog = get_latest_dialog(driver)
+        previous_output_count = latest_dialog['output_count']
+        attempt_send_action(driver, toast_present=latest_dialog['toast_present'])
+    response_timeout = generation_sleep_timer
+    poll_frequency = 0.5
+    if timing_controller is not None:
+        response_timeout = min(response_timeout, timing_controller.get_response_timeout(len(disclaimer_statement)))
+        poll_frequency = timing_controller.get_poll_frequency(len(disclaimer_statement))
+    with telemetry.span('disclaimer_wait'):
+        # generation_sleep_timer is only an upper bound; returns as soon as the reply settles
+        wait_for_response_complete(
+            driver=driver,
+            previous_output_count=previous_output_count,
+            timeout=response_timeout,
+            poll_frequency=poll_frequency,
+            )
+
+def send_prompt_and_wait_for_response(
+        driver,
+        processed_data,
+        input_text_lag_time,
+        generation_sleep_timer,
+        max_data_loading_retries,
+        retry_data_loading_wait_time,
+        input_strategy='javascript',
+        telemetry=NULL_TELEMETRY,
+        timing_controller=None,
+        stall_timeout=None,
+):
+    # The old fixed sleep plus every loading retry now form a single upper-bound timeout
+    response_timeout = generation_sleep_timer + max_data_loading_retries * retry_data_loading_wait_time
+    poll_frequency = 0.5
+    if timing_controller is not None:
+        # Learned from recent completions and scaled to this prompt's length, never above the static bounds
+        input_text_lag_time = timing_controller.get_input_timeout(len(processed_data))
+        response_timeout = timing_controller.get_response_timeout(len(processed_data))
+        poll_frequency = timing_controller.get_poll_frequency(len(processed_data))
+
+    with telemetry.span('input'):
+        input_start_time = time.monotonic()
+        search_bar = driver.find_element(By.CSS_SELECTOR, 'textarea.flex.w-full') # Find the search bar
+        # Fill the search bar, waiting at most input_text_lag_time for the text to land
+        input_strategy_used = enter_search_bar_text(driver=driver, search_bar=search_bar, text=processed_data, timeout=input_text_lag_time, input_strategy=input_strategy)
+        if timing_controller is not None and input_strategy_used == input_strategy:
+            # Fallbacks are left out so one slow recovery doesn't stretch every later deadline
+            timing_controller.record_input(len(processed_data), time.monotonic() - input_start_time)
+        latest_dialog = get_latest_dialog(driver)
+        previous_output_count = latest_dialog['output_count']
+        attempt_send_action(driver, toast_present=latest_dialog['toast_present']) # Click send data button
+
+    with telemetry.span('generation_wait', timeout=round(response_timeout, 1)):
+        response_start_time = time.monotonic()
+        response_completed = wait_for_response_complete(
+            driver=driver,
+            previous_output_count=previous_output_count,
+            timeout=response_timeout,
+            poll_frequency=poll_frequency,
+            stall_timeout=stall_timeout,
+            )
+    if timing_controller is not None:
+        timing_controller.record_response(len(processed_data), time.monotonic() - response_start_time, response_completed)
+    return response_completed
+
+def enter_search_bar_text(driver, search_bar, text, timeout, input_strategy='javascript'):
+    # Starts with input_strategy and falls back to the slower strategies after it. Setting the value
+    # in one script call or pasting is near-instant, so those only get a short confirmation window
+    strategies = INPUT_STRATEGIES[INPUT_STRATEGIES.index(input_strategy):]
+    for strategy in strategies:
+        search_bar.clear()  # Clearing the search bar before sending new data
+        try:
+            if strategy == 'javascript':
+                driver.execute_script(SET_SEARCH_BAR_VALUE_SCRIPT, search_bar, text)
+            elif strategy == 'clipboard':
+                pyperclip.copy(text)
+                paste_key = Keys.COMMAND if sys.platform == 'darwin' else Keys.CONTROL
+                search_bar.send_keys(paste_key, 'v')
+            else:
+                search_bar.send_keys(text) # One WebDriver key event per character
+        except (WebDriverException, pyperclip.PyperclipException) as e:
+            print(f"Search bar input via {strategy} failed: {e}")
+            continue
+
+        confirmation_timeout = timeout if strategy == 'keystrokes' else min(timeout, 2)
+        if wait_for_text_input(driver=driver, search_bar=search_bar, expected_text=text, timeout=confirmation_timeout):
+            return strategy
+        print(f"Search bar input via {strategy} could not be confirmed within {confirmation_timeout}s")
+    print(f"Sending anyway...")
+    return None
+
+def wait_for_text_input(driver, search_bar, expected_text, timeout):
+    expected_text = clean_processed_data(expected_text)
     try:
-        # Check if the loading spinner is present
-        loading_element = driver.find_element(By.XPATH, "//*[contains(@class, 'lucide lucide-loader animate-spin')]")
-        return loading_element is not None
-    except NoSuchElementException:
+        WebDriverWait(driver, timeout, poll_frequency=0.2).until(
+            lambda _: clean_processed_data(search_bar.get_attribute('value') or '') == expected_text
+        )
+        return True
+    except TimeoutException:
+        return False
+
+def wait_for_response_complete(driver, previous_output_count, timeout, poll_frequency=0.5, stable_polls=2, stall_timeout=None):
+    start_time = time.monotonic()
+    try:
+        WebDriverWait(
+            driver,
+            timeout,
+            poll_frequency=poll_frequency,
+            ignored_exceptions=(NoSuchElementException, StaleElementReferenceException),
+        ).until(response_generation_complete(previous_output_count=previous_output_count, stable_polls=stable_polls, stall_timeout=stall_timeout))
+        print(f"Response completed in {time.monotonic() - start_time:.1f}s")
+        return True
+    except TimeoutException:
+        print(f"Response not completed within {timeout}s")
         return False
 
+def wait_for_new_chat_ready(driver, timeout, poll_frequency=0.2):
+    try:
+        WebDriverWait(
+            driver,
+            timeout,
+            poll_frequency=poll_frequency,
+            ignored_exceptions=(NoSuchElementException, StaleElementReferenceException),
+        ).until(new_chat_ready)
+        return True
+    except TimeoutException:
+        print(f"New chat window not ready within {timeout}s")
+        return False
+
+def new_chat_ready(driver):
+    # WebDriverWait condition that is met once the previous transcript is gone, nothing is
+    # generating and the search bar is back
+    latest_dialog = get_latest_dialog(driver)
+    if latest_dialog['output_count'] > 0 or latest_dialog['send_count'] > 0 or latest_dialog['loading']:
+        return False
+    return len(driver.find_elements(By.CSS_SELECTOR, 'textarea.flex.w-full')) > 0
+
+class response_generation_complete:
+    # WebDriverWait condition (named like selenium's expected_conditions) that is met once a new
+    # output container exists, the spinner is gone, the send button is back and the output text
+    # has stopped changing for `stable_polls` consecutive polls. Doubles as a watchdog: if nothing on
+    # the page changes for stall_timeout seconds (no send, no new text) while no generation is under
+    # way it raises PageStalledError instead of waiting out the full timeout. A visible spinner or a
+    # missing send button means the site is still generating, which only the response timeout bounds
+    def __init__(self, previous_output_count, stable_polls=2, stall_timeout=None):
+        self.previous_output_count = previous_output_count
+        self.stable_polls = stable_polls
+        self.stall_timeout = stall_timeout
+        self.last_text = None
+        self.stable_count = 0
+        self.last_page_state = None
+        self.last_change_time = time.monotonic()
+
+    def __call__(self, driver):
+        latest_dialog = get_latest_dialog(driver)
+        self.check_for_stall(latest_dialog)
+        if latest_dialog['loading'] or not latest_dialog['send_button_present']:
+            self.last_text = None
+            self.stable_count = 0
+            return False
+
+        if latest_dialog['output_count'] <= self.previous_output_count:
+            return False
+
+        if latest_dialog['output_text'] != self.last_text:
+            self.last_text = latest_dialog['output_text']
+            self.stable_count = 0
+            return False
+        self.stable_count += 1
+        return self.stable_count >= self.stable_polls
+
+    def check_for_stall(self, latest_dialog):
+        page_state = (
+            latest_dialog['output_count'],
+            latest_dialog['send_count'],
+            len(latest_dialog['output_text']),
+            latest_dialog['loading'],
+            latest_dialog['send_button_present'],
+        )
+        now = time.monotonic()
+        is_generating = latest_dialog['loading'] or not latest_dialog['send_button_present']
+        if is_generating or page_state != self.last_page_state:
+            self.last_page_state = page_state
+            self.last_change_time = now
+        elif self.stall_timeout is not None and now - self.last_change_time > self.stall_timeout:
+            toast_note = " (a notification box is open)" if latest_dialog['toast_present'] else ""
+            raise PageStalledError(f"No progress on the page for {self.stall_timeout}s{toast_note}")
+
+def get_latest_dialog(driver):
+    latest_dialog = driver.execute_script(GET_LATEST_DIALOG_SCRIPT, OUTPUT_CONTAINER_CLASSES, SEND_CONTAINER_CLASSES)
+    latest_dialog['retrieved_at'] = time.time()
+    return latest_dialog
+
 def clean_processed_data(processed_data):
     # Replace one or more whitespace characters (including spaces, tabs, newlines) with a single space
     cleaned_data = re.sub(r'\s+', ' ', processed_data)
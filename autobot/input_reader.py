@@ -0,0 +1,85 @@
+import os
+import pandas as pd
+
+from fanout import expand_configurations
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+INPUT_FORMATS = ['csv', 'jsonl', 'parquet']
+
+def get_input_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.jsonl', '.ndjson']:
+        return 'jsonl'
+    if extension == '.parquet':
+        return 'parquet'
+    return 'csv'
+
+def iter_raw_chunks(path, chunk_size, input_format=None, columns=None):
+    # Parses the file chunk_size rows at a time, so memory is bounded by the chunk rather than the file
+    input_format = input_format or get_input_format(path)
+    if input_format not in INPUT_FORMATS:
+        raise ValueError(f"Unknown input format '{input_format}'. Choose from {INPUT_FORMATS}")
+    if input_format == 'parquet':
+        if pq is None:
+            raise ImportError("Reading parquet input requires pyarrow. Install it with 'pip install pyarrow'")
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield record_batch.to_pandas()
+    elif input_format == 'jsonl':
+        with pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False) as chunk_reader:
+            for chunk in chunk_reader:
+                yield chunk if columns is None else chunk.reindex(columns=columns)
+    else:
+        with pd.read_csv(path, chunksize=chunk_size, usecols=columns) as chunk_reader:
+            yield from chunk_reader
+
+def iter_input_chunks(path, chunk_size=1000, input_format=None):
+    # Yields the prompt rows chunk by chunk. A file without a prompt_id column gets the 1-based row
+    # number, counted across chunks, so ids match what loading the whole file would have given
+    rows_read = 0
+    for chunk in iter_raw_chunks(path, chunk_size, input_format):
+        if 'prompt_id' not in chunk.columns:
+            chunk['prompt_id'] = range(rows_read + 1, rows_read + len(chunk) + 1)
+        chunk = chunk.reset_index(drop=True)
+        rows_read += len(chunk)
+        yield chunk
+
+def load_prompt_ids(path, chunk_size=100000):
+    # The prompt_ids of an earlier backup file, read without loading its outputs
+    prompt_ids = set()
+    if os.path.isdir(path):
+        # A parquet ResultSink directory
+        for part_name in sorted(os.listdir(path)):
+            if part_name.endswith('.parquet'):
+                prompt_ids.update(pd.read_parquet(os.path.join(path, part_name), columns=['prompt_id'])['prompt_id'].tolist())
+        return prompt_ids
+    if os.path.getsize(path) == 0:
+        return prompt_ids
+    for chunk in iter_raw_chunks(path, chunk_size, columns=['prompt_id']):
+        prompt_ids.update(chunk['prompt_id'].dropna().tolist())
+    return prompt_ids
+
+def iter_pending_rows(input_chunks, skip_prompt_ids=None, journal=None, max_rows=None, configurations=None):
+    # Applies the backup filter, the max_rows cap (test mode) and then the run-journal filter one chunk
+    # at a time, and yields the rows still to send as dicts. Rows are registered in the journal as
+    # their chunk is reached. The cap comes before the journal so a resumed test run keeps its rows.
+    # With fan-out configurations every row becomes one task per configuration before the journal
+    # filter, so a resumed run only re-sends the configurations a prompt is still missing
+    rows_taken = 0
+    for chunk in input_chunks:
+        if skip_prompt_ids:
+            chunk = chunk[~chunk['prompt_id'].isin(skip_prompt_ids)]
+        if max_rows is not None:
+            chunk = chunk.head(max_rows - rows_taken)
+            rows_taken += len(chunk)
+        if configurations is not None:
+            chunk = expand_configurations(chunk, configurations)
+        if journal is not None:
+            chunk = journal.filter_not_done(chunk)
+            journal.register_pending(chunk['prompt_id'].tolist())
+        yield from chunk.to_dict('records')
+        if max_rows is not None and rows_taken >= max_rows:
+            return
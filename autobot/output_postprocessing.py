@@ -0,0 +1,126 @@
+import os
+import argparse
+import pandas as pd
+
+from run_journal import RETRY_OUTPUTS
+from retry_policy import REJECTED_OUTPUT
+
+# Label the chat page puts in front of every response. Only this prefix is cut off in the send loop,
+# everything else about the response is kept as captured
+OUTPUT_HEADER = 'Secure GPT (Beta)\n'
+
+def get_input_prompt_column(prompt_column_name):
+    # The prompt column of a result holds the prompt as sent; this one keeps it as it was in the input
+    return f"{prompt_column_name}_input"
+
+def strip_output_header(output_text):
+    return output_text[len(OUTPUT_HEADER):] if output_text.startswith(OUTPUT_HEADER) else output_text
+
+def normalize_outputs(outputs, lowercase=False):
+    # Flattens the captured responses to one line each, over the whole column at once. Markers such
+    # as 'DATA_LOAD_FAILURE' and 'NA' are left untouched
+    is_marker = outputs.isin(RETRY_OUTPUTS) | outputs.isna()
+    normalized = outputs.astype(str).str.replace(OUTPUT_HEADER, '', regex=False).str.replace('\n', ' ', regex=False).str.strip()
+    if lowercase:
+        normalized = normalized.str.lower()
+    return normalized.where(~is_marker, outputs)
+
+def get_first_prompt_ids(keys, prompt_ids, groups=None):
+    # For every row whose key was already seen (within its group), the prompt_id of the first row with
+    # that key. The groupby builds one hash index over the column, so each row is a single lookup
+    key_columns = [keys] if groups is None else [groups, keys]
+    first_prompt_ids = prompt_ids.groupby(key_columns, sort=False, dropna=False).transform('first')
+    is_repeated = pd.concat(key_columns, axis=1).duplicated(keep='first') & keys.notna()
+    # Object dtype keeps integer prompt_ids integers next to the empty cells
+    return first_prompt_ids.astype(object).where(is_repeated, None)
+
+def get_prompt_keys(prompts):
+    # Prompts compared whitespace-insensitively, since the page may re-flow the text it shows
+    return prompts.astype(str).str.split().str.join(' ').where(prompts.notna())
+
+def postprocess_results(
+        results_df,
+        prompt_column_name,
+        output_column_name,
+        lowercase_output=False,
+        keep_raw_output=False,
+        group_column_name=None,
+        input_prompt_column_name=None,
+):
+    # Turns the raw results of a run into the final output: normalized outputs plus a flag for every
+    # row caught by content moderation, answered with the same text as an earlier row, or recorded
+    # with another prompt than its own input_prompt_column_name that an earlier row was recorded with
+    # (the page kept showing an old prompt). A prompt that is simply in the input twice isn't flagged.
+    # Rows are only compared within their group_column_name, e.g. the configuration of a fan-out run.
+    # Returns the processed results and their quality stats
+    raw_outputs = results_df[output_column_name]
+    normalized_outputs = normalize_outputs(raw_outputs, lowercase=lowercase_output)
+    is_answered = ~(raw_outputs.isin(RETRY_OUTPUTS) | raw_outputs.isna())
+    # Compared case- and whitespace-insensitively, so a re-flowed copy still counts as the same text
+    output_keys = normalized_outputs.str.lower().str.split().str.join(' ').where(is_answered)
+    send_keys = get_prompt_keys(results_df[prompt_column_name])
+    if input_prompt_column_name is not None and input_prompt_column_name in results_df.columns:
+        # Only a row whose recorded prompt isn't its own can have picked up an old one
+        is_mismatched_send = send_keys.ne(get_prompt_keys(results_df[input_prompt_column_name])) & results_df[input_prompt_column_name].notna()
+    else:
+        is_mismatched_send = pd.Series(False, index=results_df.index)
+
+    processed_df = results_df.copy()
+    if keep_raw_output:
+        processed_df[f"{output_column_name}_raw"] = raw_outputs
+    processed_df[output_column_name] = normalized_outputs
+    processed_df['moderation_failure'] = raw_outputs == 'NA'
+    groups = results_df[group_column_name] if group_column_name is not None else None
+    processed_df['duplicate_output_of'] = get_first_prompt_ids(output_keys, results_df['prompt_id'], groups)
+    processed_df['repeated_send_of'] = get_first_prompt_ids(send_keys, results_df['prompt_id'], groups).where(is_mismatched_send, None)
+
+    word_counts = normalized_outputs[is_answered].astype(str).str.split().str.len()
+    quality_stats = {
+        'rows': len(results_df),
+        'answered': int(is_answered.sum()),
+        'moderation_failures': int(processed_df['moderation_failure'].sum()),
+        'data_load_failures': int((raw_outputs == 'DATA_LOAD_FAILURE').sum()),
+        'rejected_outputs': int((raw_outputs == REJECTED_OUTPUT).sum()),
+        'duplicate_outputs': int(processed_df['duplicate_output_of'].notna().sum()),
+        'repeated_sends': int(processed_df['repeated_send_of'].notna().sum()),
+        'min_words': int(word_counts.min()) if word_counts.notna().any() else None,
+        'median_words': float(word_counts.median()) if word_counts.notna().any() else None,
+        'mean_words': round(float(word_counts.mean()), 1) if word_counts.notna().any() else None,
+    }
+    return processed_df, quality_stats
+
+def format_quality_report(quality_stats, title='Output quality'):
+    lines = [f"{title} ({quality_stats['rows']} row(s))"]
+    lines.append(f"  answered: {quality_stats['answered']}, content moderation (NA): {quality_stats['moderation_failures']}, "
+                 f"DATA_LOAD_FAILURE: {quality_stats['data_load_failures']}, rejected: {quality_stats['rejected_outputs']}")
+    lines.append(f"  same output as an earlier row: {quality_stats['duplicate_outputs']}, recorded with an earlier row's prompt: {quality_stats['repeated_sends']}")
+    if quality_stats['min_words'] is not None:
+        lines.append(f"  words per answer: min={quality_stats['min_words']} median={quality_stats['median_words']:g} mean={quality_stats['mean_words']:g}")
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Normalize the outputs of an existing output file and report their quality')
+    parser.add_argument('--input_path', type=str, help='CSV file with the outputs to post-process')
+    parser.add_argument('--prompt_column_name', type=str, help='Column holding the prompts as sent')
+    parser.add_argument('--output_column_name', type=str, help='Column holding the outputs')
+    parser.add_argument('--input_prompt_column_name', type=str, nargs='?', help='Column holding the prompts as they were in the input, needed to flag rows recorded with an old prompt', default=None)
+    parser.add_argument('--lowercase_output', action='store_true', help='Lowercase the normalized outputs')
+    parser.add_argument('--keep_raw_output', action='store_true', help="Keep the outputs as captured in an '<output column>_raw' column")
+    parser.add_argument('--save_path', type=str, nargs='?', help='Where to write the processed file (defaults to <input>_postprocessed.csv)', default=None)
+    args = parser.parse_args()
+
+    input_path = os.path.expanduser(args.input_path)
+    results_df = pd.read_csv(input_path, keep_default_na=False, na_values=[''])
+    processed_df, quality_stats = postprocess_results(
+        results_df=results_df,
+        prompt_column_name=args.prompt_column_name,
+        output_column_name=args.output_column_name,
+        lowercase_output=args.lowercase_output,
+        keep_raw_output=args.keep_raw_output,
+        input_prompt_column_name=args.input_prompt_column_name,
+        )
+
+    print(format_quality_report(quality_stats))
+    save_path = os.path.expanduser(args.save_path) if args.save_path is not None else f"{os.path.splitext(input_path)[0]}_postprocessed.csv"
+    processed_df.to_csv(save_path, index=False)
+    print(f"Post-processed file saved to {save_path}")
@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import argparse
+import functools
+import pandas as pd
+
+from retry_policy import REJECTED_OUTPUT
+
+# Outputs the bot records in place of a response, screened before any other rule
+SENTINEL_REASONS = {
+    'DATA_LOAD_FAILURE': 'data_load_failure',
+    'NA': 'content_moderation',
+    REJECTED_OUTPUT: 'rejected_output',
+}
+
+@functools.lru_cache(maxsize=32)
+def compile_terms_pattern(terms):
+    # One regex for all the terms, built from a prefix trie so terms sharing a start ("as an ai language
+    # model", "as a language model") share the same branches. It matches case-insensitively and a space
+    # in a term matches a line break too, so the raw output is scanned once however many terms there are
+    trie = {}
+    for term in terms:
+        term = term.strip().lower()
+        if not term:
+            continue
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = True
+    if not trie:
+        return None
+    return re.compile(trie_to_pattern(trie), re.IGNORECASE)
+
+def trie_to_pattern(node):
+    branches = [(r'\s' if char == ' ' else re.escape(char)) + trie_to_pattern(child) for char, child in sorted(node.items()) if char != '']
+    if not branches:
+        return ''
+    is_term_end = '' in node
+    if len(branches) == 1 and not is_term_end:
+        return branches[0]
+    pattern = '(?:' + '|'.join(branches) + ')'
+    # A term ending here may also be the prefix of a longer one
+    return pattern + '?' if is_term_end else pattern
+
+class ValidationRule:
+    # check returns a short description of what failed, or None if the output passes
+    rule_type = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def check(self, output):
+        raise NotImplementedError
+
+class SentinelRule(ValidationRule):
+    rule_type = 'sentinel'
+
+    def __init__(self, name='sentinel'):
+        super().__init__(name)
+
+    def check(self, output):
+        return SENTINEL_REASONS.get(output)
+
+class TermsRule(ValidationRule):
+    rule_type = 'terms'
+
+    def __init__(self, terms, name='terms_to_avoid'):
+        super().__init__(name)
+        self.pattern = compile_terms_pattern(tuple(terms))
+
+    def check(self, output):
+        if self.pattern is None:
+            return None
+        match = self.pattern.search(output)
+        return f"contains '{match.group(0)}'" if match else None
+
+class RegexRule(ValidationRule):
+    rule_type = 'regex'
+
+    def __init__(self, pattern, name='regex', must_match=False, flags=re.IGNORECASE):
+        super().__init__(name)
+        self.pattern = re.compile(pattern, flags)
+        self.must_match = must_match
+
+    def check(self, output):
+        match = self.pattern.search(output)
+        if self.must_match:
+            return None if match else f"does not match /{self.pattern.pattern}/"
+        return f"matches '{match.group(0)}'" if match else None
+
+class MinWordCountRule(ValidationRule):
+    rule_type = 'min_word_count'
+
+    def __init__(self, min_words, name='min_output_word_count'):
+        super().__init__(name)
+        self.min_words = min_words
+
+    def check(self, output):
+        word_count = len(output.split())
+        return f"{word_count} words (needs more than {self.min_words})" if word_count <= self.min_words else None
+
+class MaxLengthRule(ValidationRule):
+    rule_type = 'max_length'
+
+    def __init__(self, max_chars, name='max_length'):
+        super().__init__(name)
+        self.max_chars = max_chars
+
+    def check(self, output):
+        return f"{len(output)} characters (limit {self.max_chars})" if len(output) > self.max_chars else None
+
+class JsonShapeRule(ValidationRule):
+    # The output (or the first {...} block in it) must be a JSON object holding required_keys
+    rule_type = 'json_shape'
+
+    def __init__(self, required_keys=(), name='json_shape'):
+        super().__init__(name)
+        self.required_keys = list(required_keys)
+
+    def check(self, output):
+        json_start, json_end = output.find('{'), output.rfind('}')
+        if json_start == -1 or json_end < json_start:
+            return "no JSON object"
+        try:
+            parsed_output = json.loads(output[json_start:json_end + 1])
+        except json.JSONDecodeError as e:
+            return f"invalid JSON ({e.msg})"
+        missing_keys = [key for key in self.required_keys if key not in parsed_output]
+        return f"missing keys {missing_keys}" if missing_keys else None
+
+RULE_TYPES = {rule_class.rule_type: rule_class for rule_class in [SentinelRule, TermsRule, RegexRule, MinWordCountRule, MaxLengthRule, JsonShapeRule]}
+
+class OutputValidator:
+    # Runs the rules in order and stops at the first one that fires, so cheap sentinel and term
+    # checks come before word counts and JSON parsing. Rules are compiled once per run
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+    def validate(self, output):
+        # Returns (rule_name, detail) for the first rule that fires, or None if the output passes
+        output = '' if output is None or pd.isna(output) else str(output)
+        for rule in self.rules:
+            detail = rule.check(output)
+            if detail is not None:
+                return rule.name, detail
+        return None
+
+    def get_rejection_reason(self, output):
+        validation_result = self.validate(output)
+        if validation_result is None:
+            return None
+        rule_name, detail = validation_result
+        # Sentinels carry their own reason, e.g. 'content_moderation'
+        return detail if rule_name == 'sentinel' else rule_name
+
+    def screen_dataframe(self, results_df, output_column_name):
+        # Offline re-screen of an existing output file: adds the rule that fired and why to every row
+        validation_results = [self.validate(output) for output in results_df[output_column_name].tolist()]
+        screened_df = results_df.copy()
+        screened_df['validation_rule'] = [result[0] if result else None for result in validation_results]
+        screened_df['validation_detail'] = [result[1] if result else None for result in validation_results]
+        return screened_df
+
+def load_validation_rules(rules_path):
+    # JSON list of rule specs, e.g. [{"type": "regex", "name": "apology", "pattern": "^i'?m sorry"},
+    # {"type": "max_length", "max_chars": 4000}, {"type": "json_shape", "required_keys": ["summary"]}]
+    with open(os.path.expanduser(rules_path)) as rules_file:
+        rule_specs = json.load(rules_file)
+    rules = []
+    for rule_spec in rule_specs:
+        rule_spec = dict(rule_spec)
+        rule_type = rule_spec.pop('type', None)
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f"Unknown validation rule type '{rule_type}'. Choose from {sorted(RULE_TYPES)}")
+        rules.append(RULE_TYPES[rule_type](**rule_spec))
+    return rules
+
+def build_output_validator(terms_to_avoid, min_output_word_count, rules_path=None):
+    rules = [SentinelRule(), TermsRule(terms_to_avoid)]
+    if rules_path is not None:
+        rules += load_validation_rules(rules_path)
+    rules.append(MinWordCountRule(min_output_word_count))
+    return OutputValidator(rules)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-screen an existing output file with the run-time validation rules')
+    parser.add_argument('--input_path', type=str, help='CSV file with the outputs to screen')
+    parser.add_argument('--output_column_name', type=str, help='Column holding the outputs')
+    parser.add_argument('--terms_to_avoid', type=str, help='List of terms to avoid', default='As an AI language model, As a language model, As a language AI model')
+    parser.add_argument('--min_output_word_count', type=int, nargs='?', help='Minimum word count for the output', default=40)
+    parser.add_argument('--validation_rules_path', type=str, nargs='?', help='JSON file with extra validation rules', default=None)
+    parser.add_argument('--save_path', type=str, nargs='?', help='Where to write the screened file (defaults to <input>_screened.csv)', default=None)
+    args = parser.parse_args()
+
+    output_validator = build_output_validator(
+        terms_to_avoid=[term.strip() for term in args.terms_to_avoid.split(',') if term.strip()],
+        min_output_word_count=args.min_output_word_count,
+        rules_path=args.validation_rules_path,
+        )
+    input_path = os.path.expanduser(args.input_path)
+    results_df = pd.read_csv(input_path, keep_default_na=False, na_values=[''])
+    screened_df = output_validator.screen_dataframe(results_df, args.output_column_name)
+
+    print(f"Screened {len(screened_df)} row(s)")
+    print(screened_df['validation_rule'].fillna('passed').value_counts().to_string())
+    save_path = os.path.expanduser(args.save_path) if args.save_path is not None else f"{os.path.splitext(input_path)[0]}_screened.csv"
+    screened_df.to_csv(save_path, index=False)
+    print(f"Screened file saved to {save_path}")
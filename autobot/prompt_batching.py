@@ -0,0 +1,54 @@
+import re
+
+BATCH_INSTRUCTION = (
+    "Answer each of the {prompt_count} numbered prompts below on its own, as if it had been sent alone. "
+    "Start every answer with its marker, exactly '### ANSWER <number> ###', answer the prompts in order "
+    "and do not write anything before the first marker."
+)
+# The reply is split as captured, so the markers are matched loosely (any case, any spacing or line breaks)
+ANSWER_MARKER_PATTERN = re.compile(r'#{2,}\s*answer\s*(\d+)\s*#{2,}', re.IGNORECASE)
+
+def build_batch_prompt(prompts):
+    # One chat message holding every prompt behind a numbered marker
+    batch_prompt = BATCH_INSTRUCTION.format(prompt_count=len(prompts))
+    for prompt_number, prompt in enumerate(prompts, start=1):
+        batch_prompt += f"\n### PROMPT {prompt_number} ###\n{prompt}"
+    return batch_prompt
+
+def split_batch_response(response, prompt_count):
+    # Maps each prompt number to its answer. Numbers that are missing, repeated or out of range are
+    # left out, so only those rows fall back to a single send
+    markers = list(ANSWER_MARKER_PATTERN.finditer(response))
+    answers = {}
+    repeated_numbers = set()
+    for marker_index, marker in enumerate(markers):
+        prompt_number = int(marker.group(1))
+        answer_end = markers[marker_index + 1].start() if marker_index + 1 < len(markers) else len(response)
+        answer = response[marker.end():answer_end].strip()
+        if not 1 <= prompt_number <= prompt_count or not answer:
+            continue
+        if prompt_number in answers:
+            repeated_numbers.add(prompt_number)
+        answers[prompt_number] = answer
+    for prompt_number in repeated_numbers:
+        del answers[prompt_number]
+    return answers
+
+def iter_prompt_batches(rows, prompt_column_name, max_batch_size, max_batch_chars, batch_key_column=None):
+    # Packs consecutive rows into batches of up to max_batch_size prompts and max_batch_chars prompt
+    # characters. A batch is a list of rows; a row that ends up alone is yielded as the row itself.
+    # Rows with a different batch_key_column value (e.g. another fan-out configuration) start a new
+    # batch. Works lazily, so a streamed input stays streamed
+    batch = []
+    batch_chars = 0
+    for row in rows:
+        prompt_chars = len(str(row[prompt_column_name]))
+        key_changed = batch_key_column is not None and batch and row[batch_key_column] != batch[-1][batch_key_column]
+        if batch and (key_changed or len(batch) >= max_batch_size or batch_chars + prompt_chars > max_batch_chars):
+            yield batch if len(batch) > 1 else batch[0]
+            batch = []
+            batch_chars = 0
+        batch.append(row)
+        batch_chars += prompt_chars
+    if batch:
+        yield batch if len(batch) > 1 else batch[0]
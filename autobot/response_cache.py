@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from helper_functions import clean_processed_data
+
+CACHE_MODES = ['off', 'read', 'readwrite']
+# Rows evicted per statement while shrinking an oversized cache
+EVICTION_BATCH_SIZE = 100
+
+def get_cache_key(prompt, disclaimer_statement, gpt_model, conversation_style):
+    # Prompts are normalized the same way they are sent, so whitespace-only differences share an entry.
+    # The disclaimer and the model/style settings are part of the key because they change the output
+    normalized_prompt = clean_processed_data(str(prompt).replace('\n', ' '))
+    key_material = json.dumps([normalized_prompt, disclaimer_statement or '', gpt_model, conversation_style])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    # On-disk cache of accepted SecureGPT outputs so duplicate prompts are answered without a browser
+    # round-trip. Entries older than max_age_days are ignored and purged, and the least recently used
+    # entries are evicted once the stored text exceeds max_megabytes
+    def __init__(
+            self,
+            path,
+            cache_mode,
+            disclaimer_statement,
+            gpt_model,
+            conversation_style,
+            max_megabytes=500,
+            max_age_days=30,
+    ):
+        if cache_mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode '{cache_mode}'. Choose from {CACHE_MODES}")
+        self.path = path
+        self.cache_mode = cache_mode
+        self.disclaimer_statement = disclaimer_statement
+        self.gpt_model = gpt_model
+        self.conversation_style = conversation_style
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                cache_key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                send TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)")
+        self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM responses").fetchone()[0]
+
+    def get(self, prompt, configuration=None):
+        cache_key = self._get_cache_key(prompt, configuration)
+        now = time.time()
+        with self.lock:
+            cached_row = self.connection.execute(
+                "SELECT output, send FROM responses WHERE cache_key = ? AND created_at >= ?",
+                (cache_key, now - self.max_age_seconds),
+            ).fetchone()
+            if cached_row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.cache_mode == 'readwrite':
+                self.connection.execute("UPDATE responses SET last_used_at = ? WHERE cache_key = ?", (now, cache_key))
+        return cached_row
+
+    def put(self, prompt, output, send, configuration=None):
+        if self.cache_mode != 'readwrite':
+            return
+        cache_key = self._get_cache_key(prompt, configuration)
+        output = str(output)
+        send = str(send)
+        size_bytes = len(output.encode('utf-8')) + len(send.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            previous_row = self.connection.execute("SELECT size_bytes FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (cache_key, output, send, size_bytes, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, output, send, size_bytes, now, now),
+            )
+            self.total_bytes += size_bytes - (previous_row[0] if previous_row is not None else 0)
+            self._evict_least_recently_used()
+
+    def remove(self, prompt, configuration=None):
+        # Drops an entry the run no longer accepts, e.g. after its validation rules changed
+        if self.cache_mode != 'readwrite':
+            return
+        cache_key = self._get_cache_key(prompt, configuration)
+        with self.lock:
+            removed_row = self.connection.execute("SELECT size_bytes FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+            if removed_row is not None:
+                self.connection.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+                self.total_bytes -= removed_row[0]
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_summary(self):
+        return f"Response cache: {self.hits} hit(s), {self.misses} miss(es), {self.get_hit_rate():.1%} hit rate"
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _get_cache_key(self, prompt, configuration):
+        # A fan-out run shares one cache across its configurations, each keyed by its own model and style
+        if configuration is None:
+            return get_cache_key(prompt, self.disclaimer_statement, self.gpt_model, self.conversation_style)
+        return get_cache_key(prompt, self.disclaimer_statement, configuration.gpt_model, configuration.conversation_style)
+
+    def _evict_least_recently_used(self):
+        while self.total_bytes > self.max_bytes:
+            evicted_rows = self.connection.execute(
+                "SELECT cache_key, size_bytes FROM responses ORDER BY last_used_at LIMIT ?",
+                (EVICTION_BATCH_SIZE,),
+            ).fetchall()
+            if not evicted_rows:
+                self.total_bytes = 0
+                return
+            for cache_key, size_bytes in evicted_rows:
+                if self.total_bytes <= self.max_bytes:
+                    return
+                self.connection.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+                self.total_bytes -= size_bytes
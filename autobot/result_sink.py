@@ -0,0 +1,196 @@
+import os
+import csv
+import json
+import glob
+import shutil
+import threading
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+SINK_FORMATS = ['csv', 'jsonl', 'parquet']
+
+class ResultSink:
+    # Appends every finished row to disk (and fsyncs it) as soon as it completes, so memory stays
+    # constant and a killed run only loses the rows that were still in flight.
+    # csv/jsonl sinks are a single append-only file; a parquet sink is a directory holding one
+    # part file per row group, since a parquet file is unreadable until its footer is written.
+    def __init__(self, path, columns, output_format='csv', parquet_row_group_size=100):
+        check_output_format(output_format)
+        self.path = path
+        self.columns = columns
+        self.output_format = output_format
+        self.parquet_row_group_size = parquet_row_group_size
+        self.parquet_buffer = []
+        # on_durable callbacks of the buffered parquet rows, run once their row group is on disk
+        self.pending_callbacks = []
+        self.rows_written = 0
+        self.lock = threading.Lock()
+
+        if output_format == 'parquet':
+            os.makedirs(path, exist_ok=True)
+            # Continue the part numbering of a resumed sink so earlier parts are never overwritten
+            self.parquet_part_count = len(glob.glob(os.path.join(path, 'part-*.parquet')))
+            self.file = None
+        else:
+            if os.path.exists(path):
+                # A crash interrupted the last write; cut the torn record off so the file stays readable
+                truncate_to_last_record(path, quotechar=b'"' if output_format == 'csv' else None)
+            write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            self.file = open(path, 'a', newline='', encoding='utf-8')
+            if output_format == 'csv':
+                self.csv_writer = csv.writer(self.file)
+                if write_header:
+                    self.csv_writer.writerow(columns)
+                    self._sync()
+
+    def add(self, prompt_id, row, on_durable=None):
+        # on_durable is called once the row is synced to disk: straight away for csv/jsonl, when its
+        # row group is written for parquet. Use it for anything that must not claim a row is saved
+        # before it is, e.g. marking the row finished in the run journal
+        values = [to_builtin_value(row.get(column)) for column in self.columns]
+        with self.lock:
+            if on_durable is not None:
+                self.pending_callbacks.append(on_durable)
+            if self.output_format == 'csv':
+                self.csv_writer.writerow(['' if value is None else value for value in values])
+                self._sync()
+            elif self.output_format == 'jsonl':
+                self.file.write(json.dumps(dict(zip(self.columns, values)), default=str) + '\n')
+                self._sync()
+            else:
+                self.parquet_buffer.append(dict(zip(self.columns, values)))
+                if len(self.parquet_buffer) >= self.parquet_row_group_size:
+                    self._write_parquet_row_group()
+            self.rows_written += 1
+            durable_callbacks = self._take_durable_callbacks()
+        for callback in durable_callbacks:
+            callback()
+
+    def __len__(self):
+        with self.lock:
+            return self.rows_written
+
+    def flush(self):
+        with self.lock:
+            if self.output_format == 'parquet':
+                self._write_parquet_row_group()
+            durable_callbacks = self._take_durable_callbacks()
+        for callback in durable_callbacks:
+            callback()
+
+    def close(self):
+        self.flush()
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+
+    def to_dataframe(self):
+        self.flush()
+        results = load_results(self.path)
+        if 'prompt_id' in results.columns:
+            # A resumed run appends retried rows again; the latest attempt of each prompt wins
+            results = results.drop_duplicates(subset='prompt_id', keep='last')
+            results = results.sort_values('prompt_id', kind='stable').reset_index(drop=True)
+        return results.reindex(columns=self.columns)
+
+    def remove(self):
+        self.close()
+        remove_results(self.path)
+
+    def _take_durable_callbacks(self):
+        # Called with the lock held; the callbacks run after it is released
+        if self.parquet_buffer:
+            return []
+        durable_callbacks = self.pending_callbacks
+        self.pending_callbacks = []
+        return durable_callbacks
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _write_parquet_row_group(self):
+        if not self.parquet_buffer:
+            return
+        part_path = os.path.join(self.path, f"part-{self.parquet_part_count:09d}.parquet")
+        table = pa.Table.from_pylist(self.parquet_buffer)
+        # Write under a temporary name and rename so a crash never leaves a half-written part
+        pq.write_table(table, part_path + '.tmp')
+        with open(part_path + '.tmp', 'rb') as part_file:
+            os.fsync(part_file.fileno())
+        os.replace(part_path + '.tmp', part_path)
+        self.parquet_part_count += 1
+        self.parquet_buffer = []
+
+def truncate_to_last_record(path, quotechar=None, block_size=1 << 20):
+    # Every record ends with a newline. With a quotechar (csv) a newline inside a quoted field doesn't
+    # end one: a newline ends a record only if an even number of quotes comes before it
+    with open(path, 'r+b') as result_file:
+        quotes_before = 0
+        if quotechar is not None:
+            for block in iter(lambda: result_file.read(block_size), b''):
+                quotes_before += block.count(quotechar)
+        file_size = result_file.seek(0, os.SEEK_END)
+        record_end = 0
+        block_end = file_size
+        # Walk back from the end to the last newline that closes a record
+        while block_end > 0 and record_end == 0:
+            block_start = max(0, block_end - block_size)
+            result_file.seek(block_start)
+            block = result_file.read(block_end - block_start)
+            for offset in range(len(block) - 1, -1, -1):
+                if block[offset:offset + 1] == quotechar:
+                    quotes_before -= 1
+                elif block[offset:offset + 1] == b'\n' and quotes_before % 2 == 0:
+                    record_end = block_start + offset + 1
+                    break
+            block_end = block_start
+        if record_end < file_size:
+            print(f"Dropping {file_size - record_end} byte(s) of a row cut off by an interrupted write in {path}")
+            result_file.truncate(record_end)
+            result_file.flush()
+            os.fsync(result_file.fileno())
+
+def check_output_format(output_format):
+    # Also called before a run starts its browsers, so a missing pyarrow doesn't surface after the login
+    if output_format not in SINK_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'. Choose from {SINK_FORMATS}")
+    if output_format == 'parquet' and pa is None:
+        raise ImportError("Writing parquet output requires pyarrow. Install it with 'pip install pyarrow'")
+
+def to_builtin_value(value):
+    # Converts numpy scalars and missing values so every sink format stores plain values
+    if value is None:
+        return None
+    if not isinstance(value, (str, bytes)) and pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+def remove_results(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def load_results(path):
+    # Reads results written by a ResultSink (or a plain backup CSV) back into a DataFrame
+    if os.path.isdir(path):
+        part_paths = sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+        if not part_paths:
+            return pd.DataFrame()
+        return pd.concat([pd.read_parquet(part_path) for part_path in part_paths], ignore_index=True)
+    if os.path.getsize(path) == 0:
+        return pd.DataFrame()
+    if path.endswith('.jsonl'):
+        return pd.read_json(path, lines=True, dtype=False)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    # Only empty cells are missing values; 'NA' is a real output marker
+    return pd.read_csv(path, keep_default_na=False, na_values=[''])
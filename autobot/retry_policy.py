@@ -0,0 +1,36 @@
+import random
+
+# Output recorded for a row whose every attempt was rejected by terms_to_avoid or min_output_word_count
+REJECTED_OUTPUT = 'REJECTED_OUTPUT'
+DEAD_LETTER_COLUMNS = ['prompt_id', 'prompt', 'output', 'reason', 'attempts', 'failed_at']
+
+class RetryPolicy:
+    # Decides whether a rejected row is sent again and how long to wait first. Attempt n waits a random
+    # time between half and all of base_delay_seconds * 2^(n-1), capped at max_delay_seconds, so sessions
+    # retrying at the same moment spread out instead of hitting the site together
+    def __init__(
+            self,
+            output_validator,
+            max_attempts=3,
+            base_delay_seconds=5,
+            max_delay_seconds=120,
+            random_generator=None,
+    ):
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be at least 1, got {max_attempts}")
+        self.output_validator = output_validator
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.random_generator = random_generator or random.Random()
+
+    def get_rejection_reason(self, latest_output):
+        # Name of the validation rule the output failed, or None if it can be recorded as an answer
+        return self.output_validator.get_rejection_reason(latest_output)
+
+    def should_retry(self, attempt):
+        return attempt < self.max_attempts
+
+    def get_backoff_seconds(self, attempt):
+        delay_cap = min(self.base_delay_seconds * 2 ** (attempt - 1), self.max_delay_seconds)
+        return delay_cap / 2 + self.random_generator.uniform(0, delay_cap / 2)
@@ -4,6 +4,10 @@ import re
 import json
 import argparse
 import glob
+import itertools
+import functools
+import socket
+import secrets
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
@@ -33,6 +37,104 @@ from helper_functions import (
     close_notification_box,
     click_send_data_button,
 )
+from result_sink import ResultSink, remove_results, check_output_format
+from input_reader import iter_input_chunks, iter_pending_rows, load_prompt_ids
+from worker_pool import run_worker_pool
+from run_journal import RunJournal, get_run_key
+from response_cache import ResponseCache
+from browser_setup import start_logged_in_drivers, start_driver, resolve_chromedriver_path
+from session_recovery import SessionRecovery
+from fanout import parse_configurations, assemble_results
+from output_postprocessing import format_quality_report, get_input_prompt_column
+from work_queue import serve_work_queue as serve_work_queue_rows
+from work_queue_worker import WorkQueueClient, run_work_queue_worker
+from chat_backends import SeleniumBackend, StubBackend
+from run_telemetry import RunTelemetry
+from adaptive_timing import AdaptiveTimingController
+from retry_policy import RetryPolicy, DEAD_LETTER_COLUMNS
+from output_validator import build_output_validator
+
+def start_chat_backends(
+        backend,
+        session_configurations,
+        telemetry,
+        timing_controllers,
+        website_url,
+        website_email_input=None,
+        chromedriver_path=None,
+        headless=False,
+        chrome_profile_dir=None,
+        cookies_path=None,
+        lightweight_browser=False,
+        login_timeout=30,
+        manual_login_timeout=600,
+        stub_latency_seconds=0,
+        min_seconds_between_prompts=0,
+        conversation_style='Balanced',
+        max_recovery_steps=4,
+        max_browser_restarts=2,
+        **send_kwargs,
+):
+    # One chat session per entry of session_configurations (None outside a fan-out run)
+    session_count = len(session_configurations)
+    if backend == 'stub':
+        print(f"\nUsing {session_count} local stub backend(s) instead of SecureGPT")
+        backends = [
+            StubBackend(
+                name=f"Stub {worker_id}" + (f" ({configuration})" if configuration is not None else ""),
+                latency_seconds=stub_latency_seconds,
+                configuration=configuration,
+                )
+            for worker_id, configuration in enumerate(session_configurations)
+        ]
+    else:
+        print(f"\nSetup {session_count} Chrome WebDriver session(s)")
+        if website_email_input is not None:
+            pyperclip.copy(website_email_input)
+        drivers = start_logged_in_drivers(
+            workers=session_count,
+            website_url=website_url,
+            chromedriver_path=chromedriver_path,
+            headless=headless,
+            chrome_profile_dir=chrome_profile_dir,
+            cookies_path=cookies_path,
+            lightweight_browser=lightweight_browser,
+            login_timeout=login_timeout,
+            manual_login_timeout=manual_login_timeout,
+            session_labels=[f"GPT model {configuration.gpt_model}" for configuration in session_configurations] if session_configurations[0] is not None else None,
+            )
+        # Used by the recovery ladder to reopen a session that stopped responding
+        restart_driver_kwargs = dict(
+            website_url=website_url,
+            chromedriver_path=resolve_chromedriver_path(chromedriver_path),
+            headless=headless,
+            chrome_profile_dir=chrome_profile_dir,
+            cookies_path=os.path.expanduser(cookies_path) if cookies_path is not None else None,
+            lightweight_browser=lightweight_browser,
+            )
+        backends = [
+            SeleniumBackend(
+                name=f"Worker {worker_id}" + (f" ({configuration})" if configuration is not None else ""),
+                driver=driver,
+                configuration=configuration,
+                conversation_style=conversation_style,
+                min_seconds_between_prompts=min_seconds_between_prompts,
+                # Stagger start-up so the sessions don't hit the site in lockstep
+                initial_delay_seconds=worker_id * min_seconds_between_prompts / session_count,
+                telemetry=telemetry,
+                timing_controller=timing_controllers.get(configuration),
+                recovery=SessionRecovery(
+                    restart_driver=functools.partial(start_driver, worker_id=worker_id, **restart_driver_kwargs),
+                    login_timeout=login_timeout,
+                    max_steps=max_recovery_steps,
+                    max_browser_restarts=max_browser_restarts,
+                    telemetry=telemetry,
+                    ),
+                **send_kwargs,
+                )
+            for worker_id, (driver, configuration) in enumerate(zip(drivers, session_configurations))
+        ]
+    return backends
 
 def run_auto_securegpt(
         test,
@@ -53,13 +155,68 @@ def run_auto_securegpt(
         retry_data_loading_wait_time,
         website_email_input,
         website_url,
+        workers=1,
+        min_seconds_between_prompts=0,
+        output_format='csv',
+        fresh_start=False,
+        cache_mode='off',
+        cache_path="~/.auto_securegpt/response_cache.sqlite",
+        cache_max_megabytes=500,
+        cache_max_age_days=30,
+        gpt_model='GPT-4',
+        conversation_style='Balanced',
+        input_strategy='javascript',
+        headless=False,
+        chrome_profile_dir=None,
+        cookies_path=None,
+        chromedriver_path=None,
+        lightweight_browser=False,
+        login_timeout=30,
+        backend='selenium',
+        stub_latency_seconds=0,
+        max_concurrency=None,
+        row_timeout=None,
+        telemetry_path=None,
+        show_progress=False,
+        adaptive_timing=False,
+        max_attempts=3,
+        retry_base_delay_seconds=5,
+        retry_max_delay_seconds=120,
+        max_inline_resends=0,
+        validation_rules_path=None,
+        input_chunk_size=1000,
+        input_format=None,
+        batch_size=1,
+        batch_max_chars=4000,
+        max_transcript_chars=None,
+        disclaimer_mode='separate',
+        stall_timeout=60,
+        max_recovery_steps=4,
+        max_browser_restarts=2,
+        manual_login_timeout=600,
+        configurations=None,
+        serve_work_queue=None,
+        work_queue_token=None,
+        lease_seconds=300,
+        lowercase_output=False,
+        keep_raw_output=False,
 ):
     llm_inference_timestamp = datetime.now(pytz.utc).astimezone(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d_%H:%M:%S')
 
     print(f"Formatting terms to avoid")
-    terms_to_avoid = [term.strip() for term in args.terms_to_avoid.split(',') if term.strip()]
+    terms_to_avoid = [term.strip() for term in terms_to_avoid.split(',') if term.strip()]
     print(f"Formatted terms to avoid:\n{terms_to_avoid}")
 
+    if configurations is not None:
+        # Fan-out: every prompt is answered once per model/style configuration in the same pass
+        configurations = parse_configurations(configurations)
+        print(f"\nFan-out configurations: {configurations}")
+        if serve_work_queue is not None:
+            raise ValueError("--configurations can't be combined with --serve_work_queue")
+    if serve_work_queue is not None and batch_size > 1:
+        raise ValueError("--batch_size can't be combined with --serve_work_queue")
+    check_output_format(output_format)
+
     print(f"\nExpanding Paths")
     prompt_filename = os.path.basename(input_data_path)
     input_data_path = os.path.expanduser(input_data_path)
@@ -68,88 +225,425 @@ def run_auto_securegpt(
     print(f"Paths Expanded")
 
     print(f"\nLoading Data")
-    input_data_df = pd.read_csv(input_data_path)
-    if 'prompt_id' not in input_data_df.columns:
-        input_data_df['prompt_id'] = input_data_df.index + 1
-    print(f"Data Loaded")
+    # The input is parsed input_chunk_size rows at a time as the workers need them, so start-up doesn't
+    # wait on a full parse and memory doesn't grow with the file
+    input_chunks = iter_input_chunks(input_data_path, chunk_size=input_chunk_size, input_format=input_format)
+    first_chunk = next(input_chunks, None)
+    if first_chunk is None:
+        raise ValueError(f"No rows found in {input_data_path}")
+    input_column_names = first_chunk.columns.tolist()
+    input_chunks = itertools.chain([first_chunk], input_chunks)
+    print(f"Data Loaded (first {len(first_chunk)} row(s) of the input):\n{first_chunk.head()}")
+    skip_prompt_ids = None
     if backup_data_path is not None:
         print(f"\nLoading Backup Data")
-        saved_backup_data = pd.read_csv(os.path.expanduser(backup_data_path))
-        print(f"Removing Already Processed Data from Inference Prompt Data")
-        input_data_df = input_data_df[~input_data_df['prompt_id'].isin(saved_backup_data['prompt_id'])].reset_index(drop=True)
-    print(f"Data Loaded:\n{input_data_df}")
-
-    print("\nSetup the Chrome WebDriver")
-    if website_email_input is not None:
-        pyperclip.copy(website_email_input)
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()))
-    print("Going to Website")
-    driver.get(website_url)
-    # Loop until the user inputs '1'
-    user_input = ""
-    while user_input != "1":
-        user_input = input("\nPlease set-up the GPT environment by fully logging into SecureGPT and opening a new chat window. Select your preferred GPT (GPT-3.5 vs. GPT-4) and conversation style (Creative vs. Balanced vs. Precise). Press 'Enter' after typing '1' to proceed: ")
-        if user_input == "1":
-            print("Proceeding...")
-        else:
-            print("Incorrect input. Please type '1' to proceed: ")
+        skip_prompt_ids = load_prompt_ids(os.path.expanduser(backup_data_path))
+        print(f"Skipping {len(skip_prompt_ids)} Already Processed prompt_id(s) from Inference Prompt Data")
 
     if test:
         print(f"\n\n***Loading Testing Environment***\n\n")
-        input_data_df = input_data_df.head(test_sample_size)
+        save_filename = f"TEST_{save_filename}"
+
+    # The journal and the partial results are keyed by the run definition, so re-running the same
+    # command after a crash resumes where it stopped (and retries 'DATA_LOAD_FAILURE'/'NA' rows)
+    run_key = get_run_key(input_data_path, prompt_column_name, output_column_name, test, test_sample_size, configurations)
+    run_name = f"{'TEST_' if test else ''}{os.path.splitext(prompt_filename)[0]}_{run_key}"
+    journal_path = os.path.join(save_folder_path, f".{run_name}.journal.sqlite")
+    sink_path = os.path.join(save_folder_path, f"{run_name}.partial.{output_format}")
+    dead_letter_path = os.path.join(save_folder_path, f"{run_name}.dead_letter.csv")
+    if fresh_start:
+        print(f"\nDiscarding previous progress for this run")
+        RunJournal(journal_path).remove()
+        remove_results(sink_path)
+    journal = RunJournal(journal_path)
+    print(f"\nRun journal: {journal_path}")
+    pending_rows = iter_pending_rows(
+        input_chunks=input_chunks,
+        skip_prompt_ids=skip_prompt_ids,
+        journal=journal,
+        max_rows=test_sample_size if test else None,
+        configurations=configurations,
+        )
+    # The number of rows left is only known up front when they all fit in the first chunk
+    first_pending_rows = list(itertools.islice(pending_rows, input_chunk_size + 1))
+    total_rows = len(first_pending_rows) if len(first_pending_rows) <= input_chunk_size else None
+    pending_rows = itertools.chain(first_pending_rows, pending_rows)
+    print(f"Run journal state: {journal.get_state_counts()}")
+    print(f"Rows to process: {total_rows if total_rows is not None else 'streaming from the input file'}")
+
+    # One JSONL event per timed phase, deliberate wait and finished row, for tuning the timers from data
+    if telemetry_path is None:
+        telemetry_path = os.path.join(save_folder_path, f"{run_name}.telemetry.jsonl")
+    telemetry = RunTelemetry(
+        events_path=os.path.expanduser(telemetry_path),
+        show_progress=show_progress,
+        total_rows=total_rows,
+        )
+    print(f"Run telemetry: {telemetry.events_path}")
+
+    # In a fan-out run, --workers sessions are started for every configuration
+    run_configurations = configurations if configurations is not None else [None]
+    if total_rows is not None:
+        workers = max(1, min(workers, -(-total_rows // len(run_configurations))))
+    session_configurations = [configuration for configuration in run_configurations for _ in range(workers)]
+    session_count = len(session_configurations)
+    timing_controllers = {}
+    if adaptive_timing:
+        # The static timers become the upper bounds of the learned ones. Each configuration learns its
+        # own, since models answer at different speeds
+        for configuration in run_configurations:
+            timing_controllers[configuration] = AdaptiveTimingController(
+                max_response_timeout=generation_sleep_timer + max_data_loading_retries * retry_data_loading_wait_time,
+                max_input_timeout=input_text_lag_time,
+                )
+        print(f"\nAdaptive timing enabled")
+    # One set of rules decides both the inline resends of a session and the retries of the run
+    output_validator = build_output_validator(
+        terms_to_avoid=terms_to_avoid,
+        min_output_word_count=min_output_word_count,
+        rules_path=validation_rules_path,
+        )
+    if serve_work_queue is not None:
+        # The coordinator of a distributed run only hands out rows; the workers run the browsers
+        backends = []
+    else:
+        backends = start_chat_backends(
+            backend=backend,
+            session_configurations=session_configurations,
+            telemetry=telemetry,
+            timing_controllers=timing_controllers,
+            website_url=website_url,
+            website_email_input=website_email_input,
+            chromedriver_path=chromedriver_path,
+            headless=headless,
+            chrome_profile_dir=chrome_profile_dir,
+            cookies_path=cookies_path,
+            lightweight_browser=lightweight_browser,
+            login_timeout=login_timeout,
+            manual_login_timeout=manual_login_timeout,
+            stub_latency_seconds=stub_latency_seconds,
+            min_seconds_between_prompts=min_seconds_between_prompts,
+            conversation_style=conversation_style,
+            max_recovery_steps=max_recovery_steps,
+            max_browser_restarts=max_browser_restarts,
+            input_text_lag_time=input_text_lag_time,
+            generation_sleep_timer=generation_sleep_timer,
+            max_data_loading_retries=max_data_loading_retries,
+            retry_data_loading_wait_time=retry_data_loading_wait_time,
+            max_chat_dialogs=max_chat_dialogs,
+            max_transcript_chars=max_transcript_chars,
+            disclaimer_statement=disclaimer_statement,
+            disclaimer_mode=disclaimer_mode,
+            output_validator=output_validator,
+            input_strategy=input_strategy,
+            # Further rejections go back to the retry policy, which defers the row to the end of the run
+            max_resends=max_inline_resends,
+            stall_timeout=stall_timeout,
+            )
+
+    response_cache = None
+    if cache_mode != 'off':
+        response_cache = ResponseCache(
+            path=os.path.expanduser(cache_path),
+            cache_mode=cache_mode,
+            disclaimer_statement=disclaimer_statement,
+            gpt_model=gpt_model,
+            conversation_style=conversation_style,
+            max_megabytes=cache_max_megabytes,
+            max_age_days=cache_max_age_days,
+            )
+        print(f"\nResponse cache ({cache_mode}): {response_cache.path}")
 
     print(f"\nGenerating Data")
-    original_column_names = input_data_df.columns.tolist()
-    llm_output = pd.DataFrame(columns=original_column_names + [output_column_name])
-    global_iteration = 0
-    total_iterations = len(input_data_df)
-
-    for index, row in input_data_df.iterrows():
-        try:
-            global_iteration += 1
-            print(f"\n\nProcessing iteration {global_iteration}/{total_iterations}")
-            latest_output, latest_send = send_data_and_get_output(
-                driver=driver,
-                prompt=row[prompt_column_name], 
-                input_text_lag_time=input_text_lag_time,
-                generation_sleep_timer=generation_sleep_timer,
-                max_data_loading_retries=max_data_loading_retries,
-                retry_data_loading_wait_time=retry_data_loading_wait_time,
-                max_chat_dialogs=max_chat_dialogs,
-                global_iteration=global_iteration,
-                total_iterations=total_iterations,
-                llm_output=llm_output,
+    # Every finished row is appended to this file straight away; the final output is assembled from it
+    result_sink = ResultSink(
+        path=sink_path,
+        # A fan-out run writes one task row per prompt and configuration, pivoted to columns at the end
+        columns=input_column_names + (['source_prompt_id', 'configuration'] if configurations is not None else []) + [get_input_prompt_column(prompt_column_name), output_column_name],
+        output_format=output_format,
+        )
+    print(f"Streaming results to {sink_path}")
+
+    # Rejected outputs are retried up to max_attempts times, after the rest of the rows.
+    # Rows that are still rejected are recorded with the reason in the dead-letter file
+    retry_policy = RetryPolicy(
+        output_validator=output_validator,
+        max_attempts=max_attempts,
+        base_delay_seconds=retry_base_delay_seconds,
+        max_delay_seconds=retry_max_delay_seconds,
+        )
+    dead_letter_sink = ResultSink(path=dead_letter_path, columns=DEAD_LETTER_COLUMNS)
+
+    try:
+        if serve_work_queue is not None:
+            if work_queue_token is None:
+                work_queue_token = secrets.token_urlsafe(16)
+                print(f"\nWork queue token (pass it to the workers with --work_queue_token): {work_queue_token}")
+            serve_work_queue_rows(
+                address=serve_work_queue,
+                queue_path=os.path.join(save_folder_path, f".{run_name}.work_queue.sqlite"),
+                rows=pending_rows,
+                result_sink=result_sink,
+                journal=journal,
+                dead_letter_sink=dead_letter_sink,
+                # Everything that decides what an accepted output looks like comes from the coordinator,
+                # so every worker answers the prompts the same way
+                settings=dict(
+                    prompt_column_name=prompt_column_name,
+                    output_column_name=output_column_name,
+                    disclaimer_statement=disclaimer_statement,
+                    disclaimer_mode=disclaimer_mode,
+                    terms_to_avoid=terms_to_avoid,
+                    min_output_word_count=min_output_word_count,
+                    max_attempts=max_attempts,
+                    retry_base_delay_seconds=retry_base_delay_seconds,
+                    retry_max_delay_seconds=retry_max_delay_seconds,
+                    ),
+                token=work_queue_token,
+                telemetry=telemetry,
+                lease_seconds=lease_seconds,
+                )
+        else:
+            run_worker_pool(
+                backends=backends,
+                input_rows=pending_rows,
+                total_rows=total_rows,
+                batch_size=batch_size,
+                batch_max_chars=batch_max_chars,
+                result_sink=result_sink,
+                journal=journal,
+                response_cache=response_cache,
                 prompt_column_name=prompt_column_name,
                 output_column_name=output_column_name,
-                disclaimer_statement=disclaimer_statement,
-                terms_to_avoid=terms_to_avoid,
-                min_output_word_count=min_output_word_count,
+                max_concurrency=max_concurrency,
+                row_timeout=row_timeout,
+                telemetry=telemetry,
+                retry_policy=retry_policy,
+                dead_letter_sink=dead_letter_sink,
+                configurations=configurations,
+                max_buffered_rows=input_chunk_size,
                 )
-
-            current_data = {col: row[col] for col in input_data_df.columns}
-            current_data[prompt_column_name] = latest_send
-            current_data[output_column_name] = latest_output
-            llm_output = pd.concat([llm_output, pd.DataFrame([current_data])], ignore_index=True)
-        except Exception as e:
-            print("An error occurred. Saving progress...")
-            error_timestamp = datetime.now(pytz.utc).astimezone(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d_%H:%M:%S')
-            save_progress_filename = f"llm_output_backup_{error_timestamp}.csv"
-            full_path = os.path.join(save_folder_path, save_progress_filename)
-            llm_output.to_csv(full_path, index=False)
-            print(f"Progress saved to {full_path}")
-            raise e
+    except Exception as e:
+        print("An error occurred. Saving progress...")
+        error_timestamp = datetime.now(pytz.utc).astimezone(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d_%H:%M:%S')
+        save_progress_filename = f"llm_output_backup_{error_timestamp}.csv"
+        full_path = os.path.join(save_folder_path, save_progress_filename)
+        assemble_results(
+            result_sink=result_sink,
+            final_path=full_path,
+            input_column_names=input_column_names,
+            prompt_column_name=prompt_column_name,
+            output_column_name=output_column_name,
+            configurations=configurations,
+            lowercase_output=lowercase_output,
+            keep_raw_output=keep_raw_output,
+            )
+        result_sink.close()
+        dead_letter_sink.close()
+        journal.close()
+        print(f"\n{telemetry.get_summary()}")
+        telemetry.close()
+        print(f"Progress saved to {full_path}. Re-run the same command to resume.")
+        raise e
     print(f"Data Generated")
 
     print(f"\nQuitting Chrome WebDriver")
-    driver.quit()
+    for chat_backend in backends:
+        chat_backend.close()
     print(f"Chrome Driver Quit")
 
     print(f"\nSaving Data")
-    if test:
-        save_filename = f"TEST_{save_filename}"
     full_path = os.path.join(save_folder_path, save_filename)
-    llm_output.to_csv(full_path, index=False)
+    # The outputs are kept as captured until here and normalized in one vectorized pass
+    quality_stats = assemble_results(
+        result_sink=result_sink,
+        final_path=full_path,
+        input_column_names=input_column_names,
+        prompt_column_name=prompt_column_name,
+        output_column_name=output_column_name,
+        configurations=configurations,
+        lowercase_output=lowercase_output,
+        keep_raw_output=keep_raw_output,
+        )
     print(f"Data Saved to {full_path}")
+    print(f"\n{format_quality_report(quality_stats)}")
+
+    if response_cache is not None:
+        print(f"\n{response_cache.get_summary()}")
+        response_cache.close()
+
+    print(f"\n{telemetry.get_summary()}")
+    telemetry.close()
+    for configuration, timing_controller in timing_controllers.items():
+        print((f"{configuration}: " if configuration is not None else "") + timing_controller.get_summary())
+    for chat_backend in backends:
+        if getattr(chat_backend, 'recovery', None) is not None:
+            print(f"[{chat_backend.name}] Recovery steps: {chat_backend.recovery.get_summary()}")
+
+    dead_letter_rows = len(dead_letter_sink.to_dataframe())
+    if dead_letter_rows > 0:
+        dead_letter_sink.close()
+        print(f"\n{dead_letter_rows} row(s) in the dead-letter file with their rejection reason: {dead_letter_path}")
+    else:
+        dead_letter_sink.remove()
+
+    journal_state_counts = journal.get_state_counts()
+    print(f"\nRun journal state: {journal_state_counts}")
+    # Rows still 'pending' or 'sent' never made it to the results, e.g. a write that failed on the coordinator
+    unfinished_rows = journal_state_counts['failed'] + journal_state_counts['sent'] + journal_state_counts['pending']
+    if unfinished_rows == 0:
+        result_sink.remove()
+        journal.remove()
+    else:
+        result_sink.close()
+        journal.close()
+        print(f"{unfinished_rows} row(s) failed or unfinished. Re-run the same command to retry them.")
+
+def run_work_queue_worker_node(
+        work_queue_url,
+        work_queue_token,
+        save_folder_path,
+        website_email_input,
+        website_url,
+        max_chat_dialogs,
+        input_text_lag_time,
+        generation_sleep_timer,
+        max_data_loading_retries,
+        retry_data_loading_wait_time,
+        workers=1,
+        min_seconds_between_prompts=0,
+        cache_mode='off',
+        cache_path="~/.auto_securegpt/response_cache.sqlite",
+        cache_max_megabytes=500,
+        cache_max_age_days=30,
+        gpt_model='GPT-4',
+        conversation_style='Balanced',
+        input_strategy='javascript',
+        headless=False,
+        chrome_profile_dir=None,
+        cookies_path=None,
+        chromedriver_path=None,
+        lightweight_browser=False,
+        login_timeout=30,
+        backend='selenium',
+        stub_latency_seconds=0,
+        telemetry_path=None,
+        show_progress=False,
+        adaptive_timing=False,
+        max_inline_resends=0,
+        validation_rules_path=None,
+        max_transcript_chars=None,
+        stall_timeout=60,
+        max_recovery_steps=4,
+        max_browser_restarts=2,
+        manual_login_timeout=600,
+):
+    # Worker of a distributed run: rows are leased from the coordinator started with --serve_work_queue
+    # and every result goes straight back to it. The coordinator owns the input, the run journal and
+    # the output files, so a worker that crashes only costs the rows it had in flight
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    save_folder_path = os.path.expanduser(save_folder_path)
+    work_queue_client = WorkQueueClient(url=work_queue_url, token=work_queue_token, worker_id=worker_id)
+    print(f"Connecting to the work queue coordinator at {work_queue_url}")
+    work_queue_settings = work_queue_client.get_settings()
+    prompt_column_name = work_queue_settings['prompt_column_name']
+    output_column_name = work_queue_settings['output_column_name']
+    print(f"Joined the work queue as {worker_id} (prompt column '{prompt_column_name}', output column '{output_column_name}')")
+    # The coordinator's output checks plus this worker's own --validation_rules_path, used for the
+    # inline resends and the retries alike
+    output_validator = build_output_validator(
+        terms_to_avoid=work_queue_settings['terms_to_avoid'],
+        min_output_word_count=work_queue_settings['min_output_word_count'],
+        rules_path=validation_rules_path,
+        )
+
+    if telemetry_path is None:
+        telemetry_path = os.path.join(save_folder_path, f"work_queue_worker_{worker_id}.telemetry.jsonl")
+    telemetry = RunTelemetry(events_path=os.path.expanduser(telemetry_path), show_progress=show_progress)
+    print(f"Run telemetry: {telemetry.events_path}")
+
+    timing_controllers = {}
+    if adaptive_timing:
+        timing_controllers[None] = AdaptiveTimingController(
+            max_response_timeout=generation_sleep_timer + max_data_loading_retries * retry_data_loading_wait_time,
+            max_input_timeout=input_text_lag_time,
+            )
+        print(f"\nAdaptive timing enabled")
+    backends = start_chat_backends(
+        backend=backend,
+        session_configurations=[None] * workers,
+        telemetry=telemetry,
+        timing_controllers=timing_controllers,
+        website_url=website_url,
+        website_email_input=website_email_input,
+        chromedriver_path=chromedriver_path,
+        headless=headless,
+        chrome_profile_dir=chrome_profile_dir,
+        cookies_path=cookies_path,
+        lightweight_browser=lightweight_browser,
+        login_timeout=login_timeout,
+        manual_login_timeout=manual_login_timeout,
+        stub_latency_seconds=stub_latency_seconds,
+        min_seconds_between_prompts=min_seconds_between_prompts,
+        conversation_style=conversation_style,
+        max_recovery_steps=max_recovery_steps,
+        max_browser_restarts=max_browser_restarts,
+        input_text_lag_time=input_text_lag_time,
+        generation_sleep_timer=generation_sleep_timer,
+        max_data_loading_retries=max_data_loading_retries,
+        retry_data_loading_wait_time=retry_data_loading_wait_time,
+        max_chat_dialogs=max_chat_dialogs,
+        max_transcript_chars=max_transcript_chars,
+        disclaimer_statement=work_queue_settings['disclaimer_statement'],
+        disclaimer_mode=work_queue_settings['disclaimer_mode'],
+        output_validator=output_validator,
+        input_strategy=input_strategy,
+        max_resends=max_inline_resends,
+        stall_timeout=stall_timeout,
+        )
+
+    response_cache = None
+    if cache_mode != 'off':
+        response_cache = ResponseCache(
+            path=os.path.expanduser(cache_path),
+            cache_mode=cache_mode,
+            disclaimer_statement=work_queue_settings['disclaimer_statement'],
+            gpt_model=gpt_model,
+            conversation_style=conversation_style,
+            max_megabytes=cache_max_megabytes,
+            max_age_days=cache_max_age_days,
+            )
+        print(f"\nResponse cache ({cache_mode}): {response_cache.path}")
+
+    retry_policy = RetryPolicy(
+        output_validator=output_validator,
+        max_attempts=work_queue_settings['max_attempts'],
+        base_delay_seconds=work_queue_settings['retry_base_delay_seconds'],
+        max_delay_seconds=work_queue_settings['retry_max_delay_seconds'],
+        )
+
+    print(f"\nGenerating Data")
+    work_queue_client.start_heartbeat(lease_seconds=work_queue_settings['lease_seconds'])
+    try:
+        run_work_queue_worker(
+            backends=backends,
+            client=work_queue_client,
+            prompt_column_name=prompt_column_name,
+            output_column_name=output_column_name,
+            response_cache=response_cache,
+            telemetry=telemetry,
+            retry_policy=retry_policy,
+            )
+    finally:
+        work_queue_client.close()
+        for chat_backend in backends:
+            chat_backend.close()
+        if response_cache is not None:
+            print(f"\n{response_cache.get_summary()}")
+            response_cache.close()
+        print(f"\n{telemetry.get_summary()}")
+        telemetry.close()
+    print(f"Work queue finished. The results are with the coordinator")
 
 if __name__ == "__main__":
     # Set up argument parser
@@ -171,9 +665,105 @@ if __name__ == "__main__":
     parser.add_argument('--max_data_loading_retries', type=int, nargs='?', help='Maximum retries for data loading', default=10)
     parser.add_argument('--retry_data_loading_wait_time', type=int, nargs='?', help='Wait time between data loading retries', default=5)
     parser.add_argument('--website_email_input', type=str, nargs='?', help='Email input for website', default=None)
+    parser.add_argument('--website_url', type=str, nargs='?', help='SecureGPT chat page (point it at benchmarks/mock_securegpt_server.py to test offline)', default="https://securegpt.stanfordhealthcare.org/chat")
+    parser.add_argument('--workers', type=int, nargs='?', help='Number of browser sessions processing prompts concurrently', default=1)
+    parser.add_argument('--min_seconds_between_prompts', type=float, nargs='?', help='Minimum seconds between two prompts sent by the same worker', default=0)
+    parser.add_argument('--fresh_start', action='store_true', help='Ignore progress saved by a previous attempt of the same run')
+    parser.add_argument('--cache_mode', type=str, choices=['off', 'read', 'readwrite'], help='Reuse stored outputs for prompts that were already answered', default='off')
+    parser.add_argument('--cache_path', type=str, nargs='?', help='Path to the response cache database', default="~/.auto_securegpt/response_cache.sqlite")
+    parser.add_argument('--cache_max_megabytes', type=float, nargs='?', help='Least recently used cache entries are evicted above this size', default=500)
+    parser.add_argument('--cache_max_age_days', type=float, nargs='?', help='Cache entries older than this are ignored and purged', default=30)
+    parser.add_argument('--gpt_model', type=str, nargs='?', help='GPT model selected in SecureGPT (part of the response cache key)', default='GPT-4')
+    parser.add_argument('--conversation_style', type=str, nargs='?', help='Conversation style selected in SecureGPT (part of the response cache key)', default='Balanced')
+    parser.add_argument('--input_strategy', type=str, choices=['javascript', 'clipboard', 'keystrokes'], help='First strategy tried for typing prompts into the search bar (later ones are fallbacks)', default='javascript')
+    parser.add_argument('--headless', action='store_true', help='Run Chrome without a window (needs a login saved with --chrome_profile_dir or --cookies_path)')
+    parser.add_argument('--chrome_profile_dir', type=str, nargs='?', help='Chrome profile directory kept between runs so the SecureGPT login is reused', default=None)
+    parser.add_argument('--cookies_path', type=str, nargs='?', help='File the SecureGPT session cookies are saved to and restored from', default=None)
+    parser.add_argument('--chromedriver_path', type=str, nargs='?', help='Local chromedriver to use instead of resolving one with ChromeDriverManager', default=None)
+    parser.add_argument('--lightweight_browser', action='store_true', help='Disable images, web fonts and extensions to cut per-browser memory and CPU')
+    parser.add_argument('--login_timeout', type=int, nargs='?', help='Seconds to wait for a saved login to open the chat page', default=30)
+    parser.add_argument('--backend', type=str, choices=['selenium', 'stub'], help="Chat backend: 'selenium' drives SecureGPT in Chrome, 'stub' answers locally for dry runs", default='selenium')
+    parser.add_argument('--stub_latency_seconds', type=float, nargs='?', help='Simulated response time of the stub backend', default=0)
+    parser.add_argument('--max_concurrency', type=int, nargs='?', help='Maximum number of prompts in flight at once (defaults to --workers)', default=None)
+    parser.add_argument('--row_timeout', type=float, nargs='?', help='Seconds after which a row is handed to another session and the stuck session is retired', default=None)
+    parser.add_argument('--output_format', type=str, choices=['csv', 'jsonl', 'parquet'], help='Format results are streamed to disk in while the run is in progress', default='csv')
+    parser.add_argument('--telemetry_path', type=str, nargs='?', help='JSONL file the per-phase timing events are appended to (defaults to the save folder)', default=None)
+    parser.add_argument('--show_progress', action='store_true', help='Print a live progress line with throughput and ETA after every row')
+    parser.add_argument('--adaptive_timing', action='store_true', help='Learn the input and response deadlines and the polling interval from observed latencies (the timer arguments become upper bounds)')
+    parser.add_argument('--max_attempts', type=int, nargs='?', help='Times a prompt is sent before a rejected output goes to the dead-letter file', default=3)
+    parser.add_argument('--retry_base_delay_seconds', type=float, nargs='?', help='Backoff before the first retry, doubled for every later one (with jitter)', default=5)
+    parser.add_argument('--retry_max_delay_seconds', type=float, nargs='?', help='Longest backoff between two attempts of a prompt', default=120)
+    parser.add_argument('--max_inline_resends', type=int, nargs='?', help='Resends in a fresh chat window before a rejected row is deferred to the end of the run', default=0)
+    parser.add_argument('--validation_rules_path', type=str, nargs='?', help='JSON file with extra output validation rules (regex, max_length, json_shape, terms, min_word_count)', default=None)
+    parser.add_argument('--input_chunk_size', type=int, nargs='?', help='Rows parsed from the input file at a time', default=1000)
+    parser.add_argument('--input_format', type=str, choices=['csv', 'jsonl', 'parquet'], help='Input file format (defaults to the file extension, csv otherwise)', default=None)
+    parser.add_argument('--batch_size', type=int, nargs='?', help='Maximum number of prompts packed into one chat message (1 turns batching off)', default=1)
+    parser.add_argument('--batch_max_chars', type=int, nargs='?', help='Maximum prompt characters packed into one batched message', default=4000)
+    parser.add_argument('--max_transcript_chars', type=int, nargs='?', help='Open a new chat window once the prompts and outputs of the current one reach this many characters', default=None)
+    parser.add_argument('--stall_timeout', type=float, nargs='?', help='Seconds without any change on the page (while no response is being generated) after which a send counts as stalled and the recovery ladder starts', default=60)
+    parser.add_argument('--max_recovery_steps', type=int, nargs='?', help='Recovery steps tried for one prompt (dismiss notification, refresh page, new chat, restart browser) before the session is retired', default=4)
+    parser.add_argument('--max_browser_restarts', type=int, nargs='?', help='Browser restarts allowed per session', default=2)
+    parser.add_argument('--manual_login_timeout', type=int, nargs='?', help='Seconds to wait for a login by hand when the run has no terminal to prompt on', default=600)
+    parser.add_argument('--configurations', type=str, nargs='?', help="Fan-out: comma-separated '<gpt_model>:<conversation_style>' pairs, each answered by its own session(s) and written to its own output column", default=None)
+    parser.add_argument('--serve_work_queue', type=str, nargs='?', help="Coordinate a distributed run: serve the input's rows to workers on this 'host:port' instead of starting browsers here", default=None)
+    parser.add_argument('--work_queue_url', type=str, nargs='?', help='Run as a worker of a distributed run, leasing rows from the coordinator at this URL (e.g. http://10.0.0.5:8800)', default=None)
+    parser.add_argument('--work_queue_token', type=str, nargs='?', help='Shared secret between the coordinator and its workers (the coordinator prints a random one if not set)', default=None)
+    parser.add_argument('--lease_seconds', type=float, nargs='?', help='Seconds a worker may hold a row without renewing its lease before it is handed to another worker', default=300)
+    parser.add_argument('--lowercase_output', action='store_true', help='Lowercase the outputs in the final file, as older versions did (the run itself always keeps them as captured)')
+    parser.add_argument('--keep_raw_output', action='store_true', help="Also write the outputs as captured, line breaks included, to an '<output_column_name>_raw' column")
+    parser.add_argument('--disclaimer_mode', type=str, choices=['separate', 'prepend'], help="'separate' sends the disclaimer as its own message in every new chat, 'prepend' puts it in front of the chat's first prompt", default='separate')
     args = parser.parse_args()
-    
-    website_url = "https://securegpt.stanfordhealthcare.org/chat"
+
+    if args.work_queue_url is not None:
+        if args.work_queue_token is None:
+            parser.error('--work_queue_url needs the --work_queue_token printed by the coordinator')
+        run_work_queue_worker_node(
+            work_queue_url=args.work_queue_url,
+            work_queue_token=args.work_queue_token,
+            save_folder_path=args.save_folder_path,
+            website_email_input=args.website_email_input,
+            website_url=args.website_url,
+            max_chat_dialogs=args.max_chat_dialogs,
+            input_text_lag_time=args.input_text_lag_time,
+            generation_sleep_timer=args.generation_sleep_timer,
+            max_data_loading_retries=args.max_data_loading_retries,
+            retry_data_loading_wait_time=args.retry_data_loading_wait_time,
+            workers=args.workers,
+            min_seconds_between_prompts=args.min_seconds_between_prompts,
+            cache_mode=args.cache_mode,
+            cache_path=args.cache_path,
+            cache_max_megabytes=args.cache_max_megabytes,
+            cache_max_age_days=args.cache_max_age_days,
+            gpt_model=args.gpt_model,
+            conversation_style=args.conversation_style,
+            input_strategy=args.input_strategy,
+            headless=args.headless,
+            chrome_profile_dir=args.chrome_profile_dir,
+            cookies_path=args.cookies_path,
+            chromedriver_path=args.chromedriver_path,
+            lightweight_browser=args.lightweight_browser,
+            login_timeout=args.login_timeout,
+            backend=args.backend,
+            stub_latency_seconds=args.stub_latency_seconds,
+            telemetry_path=args.telemetry_path,
+            show_progress=args.show_progress,
+            adaptive_timing=args.adaptive_timing,
+            max_inline_resends=args.max_inline_resends,
+            validation_rules_path=args.validation_rules_path,
+            max_transcript_chars=args.max_transcript_chars,
+            stall_timeout=args.stall_timeout,
+            max_recovery_steps=args.max_recovery_steps,
+            max_browser_restarts=args.max_browser_restarts,
+            manual_login_timeout=args.manual_login_timeout,
+            )
+        sys.exit(0)
+
+    # Workers don't write results, only a run that does needs its output format's dependencies
+    try:
+        check_output_format(args.output_format)
+    except ImportError as e:
+        parser.error(str(e))
+
     run_auto_securegpt(
         test=args.test,
         test_sample_size=args.test_sample_size,
@@ -192,5 +782,50 @@ if __name__ == "__main__":
         max_data_loading_retries=args.max_data_loading_retries,
         retry_data_loading_wait_time=args.retry_data_loading_wait_time,
         website_email_input=args.website_email_input,
-        website_url=website_url,
+        website_url=args.website_url,
+        workers=args.workers,
+        min_seconds_between_prompts=args.min_seconds_between_prompts,
+        output_format=args.output_format,
+        fresh_start=args.fresh_start,
+        cache_mode=args.cache_mode,
+        cache_path=args.cache_path,
+        cache_max_megabytes=args.cache_max_megabytes,
+        cache_max_age_days=args.cache_max_age_days,
+        gpt_model=args.gpt_model,
+        conversation_style=args.conversation_style,
+        input_strategy=args.input_strategy,
+        headless=args.headless,
+        chrome_profile_dir=args.chrome_profile_dir,
+        cookies_path=args.cookies_path,
+        chromedriver_path=args.chromedriver_path,
+        lightweight_browser=args.lightweight_browser,
+        login_timeout=args.login_timeout,
+        backend=args.backend,
+        stub_latency_seconds=args.stub_latency_seconds,
+        max_concurrency=args.max_concurrency,
+        row_timeout=args.row_timeout,
+        telemetry_path=args.telemetry_path,
+        show_progress=args.show_progress,
+        adaptive_timing=args.adaptive_timing,
+        max_attempts=args.max_attempts,
+        retry_base_delay_seconds=args.retry_base_delay_seconds,
+        retry_max_delay_seconds=args.retry_max_delay_seconds,
+        max_inline_resends=args.max_inline_resends,
+        validation_rules_path=args.validation_rules_path,
+        input_chunk_size=args.input_chunk_size,
+        input_format=args.input_format,
+        batch_size=args.batch_size,
+        batch_max_chars=args.batch_max_chars,
+        max_transcript_chars=args.max_transcript_chars,
+        disclaimer_mode=args.disclaimer_mode,
+        stall_timeout=args.stall_timeout,
+        max_recovery_steps=args.max_recovery_steps,
+        max_browser_restarts=args.max_browser_restarts,
+        manual_login_timeout=args.manual_login_timeout,
+        configurations=args.configurations,
+        serve_work_queue=args.serve_work_queue,
+        work_queue_token=args.work_queue_token,
+        lease_seconds=args.lease_seconds,
+        lowercase_output=args.lowercase_output,
+        keep_raw_output=args.keep_raw_output,
         )
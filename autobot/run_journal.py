@@ -0,0 +1,118 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from retry_policy import REJECTED_OUTPUT
+
+JOURNAL_STATES = ['pending', 'sent', 'done', 'failed']
+# Outputs recorded for rows that should be sent again when the run is resumed
+RETRY_OUTPUTS = ['DATA_LOAD_FAILURE', 'NA', REJECTED_OUTPUT]
+# Stay below SQLite's default limit on host parameters per statement
+QUERY_BATCH_SIZE = 900
+
+def get_run_key(input_data_path, prompt_column_name, output_column_name, test, test_sample_size, configurations=None):
+    # Identifies "the same command" so a restarted run picks up its own journal and partial results
+    run_definition = '|'.join([
+        os.path.abspath(input_data_path),
+        str(prompt_column_name),
+        str(output_column_name),
+        f"test={test_sample_size}" if test else 'full',
+    ])
+    if configurations is not None:
+        # A fan-out run keys its tasks by configuration, so it never shares progress with a plain run
+        run_definition += '|' + ','.join(configuration.name for configuration in configurations)
+    return hashlib.sha256(run_definition.encode('utf-8')).hexdigest()[:12]
+
+def hash_output(output):
+    return hashlib.sha256(str(output).encode('utf-8')).hexdigest()
+
+class RunJournal:
+    # Crash-safe record of every prompt_id in a run, stored in SQLite (WAL mode). The prompt_id
+    # primary key keeps "has this prompt already been done?" an index lookup however large the input is
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS prompts (
+                prompt_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                latency_seconds REAL,
+                output_hash TEXT,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+
+    def register_pending(self, prompt_ids):
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO prompts (prompt_id, state, updated_at) VALUES (?, 'pending', ?)",
+                [(str(prompt_id), time.time()) for prompt_id in prompt_ids],
+            )
+            self.connection.execute("COMMIT")
+
+    def get_done_prompt_ids(self, prompt_ids):
+        prompt_ids = [str(prompt_id) for prompt_id in prompt_ids]
+        done_prompt_ids = set()
+        with self.lock:
+            for start in range(0, len(prompt_ids), QUERY_BATCH_SIZE):
+                batch = prompt_ids[start:start + QUERY_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT prompt_id FROM prompts WHERE state = 'done' AND prompt_id IN ({placeholders})",
+                    batch,
+                )
+                done_prompt_ids.update(row[0] for row in rows)
+        return done_prompt_ids
+
+    def filter_not_done(self, input_data_df):
+        # Drops rows whose prompt_id has already been completed by an earlier attempt of this run
+        done_prompt_ids = self.get_done_prompt_ids(input_data_df['prompt_id'].tolist())
+        if not done_prompt_ids:
+            return input_data_df
+        is_done = input_data_df['prompt_id'].astype(str).isin(done_prompt_ids)
+        return input_data_df[~is_done].reset_index(drop=True)
+
+    def mark_sent(self, prompt_id):
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO prompts (prompt_id, state, attempts, updated_at) VALUES (?, 'sent', 1, ?)
+                ON CONFLICT(prompt_id) DO UPDATE SET state = 'sent', attempts = attempts + 1, updated_at = excluded.updated_at
+                """,
+                (str(prompt_id), time.time()),
+            )
+
+    def mark_finished(self, prompt_id, output, latency_seconds):
+        state = 'failed' if output in RETRY_OUTPUTS else 'done'
+        with self.lock:
+            self.connection.execute(
+                "UPDATE prompts SET state = ?, latency_seconds = ?, output_hash = ?, updated_at = ? WHERE prompt_id = ?",
+                (state, latency_seconds, hash_output(output), time.time(), str(prompt_id)),
+            )
+        return state
+
+    def get_state_counts(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM prompts GROUP BY state").fetchall()
+        state_counts = {state: 0 for state in JOURNAL_STATES}
+        state_counts.update(dict(rows))
+        return state_counts
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def remove(self):
+        self.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
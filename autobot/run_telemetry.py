@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets; fixed buckets keep memory flat on long runs
+HISTOGRAM_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, float('inf')]
+# Phases in which a session sits idle on purpose rather than waiting on the page; their total is the
+# wasted wait reported at the end of a run
+WAIT_PHASES = ['rate_limit', 'retry_backoff', 'queue_wait']
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile
+        if self.count == 0:
+            return None
+        rank = percent / 100 * self.count
+        cumulative_count = 0
+        for bucket_bound, bucket_count in zip(HISTOGRAM_BUCKETS, self.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return min(bucket_bound, self.max_seconds)
+        return self.max_seconds
+
+    def format_buckets(self):
+        bucket_labels = []
+        lower_bound = 0
+        for bucket_bound, bucket_count in zip(HISTOGRAM_BUCKETS, self.bucket_counts):
+            if bucket_count:
+                upper_label = f"{bucket_bound:g}s" if bucket_bound != float('inf') else "inf"
+                bucket_labels.append(f"{lower_bound:g}-{upper_label}: {bucket_count}")
+            lower_bound = bucket_bound
+        return ', '.join(bucket_labels)
+
+class RunTelemetry:
+    # Times every phase of a row and appends one JSONL event per span and finished row.
+    # The row id, attempt and worker come from a per-thread context, so the helper functions
+    # only need to name the phase they are in
+    def __init__(self, events_path=None, show_progress=False, total_rows=None):
+        self.events_path = events_path
+        self.show_progress = show_progress
+        self.total_rows = total_rows
+        self.phase_histograms = {}
+        self.row_histogram = LatencyHistogram()
+        self.finished_rows = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events_file = None
+        if events_path is not None:
+            os.makedirs(os.path.dirname(events_path) or '.', exist_ok=True)
+            self.events_file = open(events_path, 'a', encoding='utf-8')
+
+    @contextmanager
+    def row_context(self, row_id, worker):
+        self.local.row_id = row_id
+        self.local.worker = worker
+        self.local.attempt = 1
+        try:
+            yield
+        finally:
+            self.local.row_id = None
+            self.local.worker = None
+            self.local.attempt = None
+
+    def set_attempt(self, attempt):
+        self.local.attempt = attempt
+
+    @contextmanager
+    def span(self, phase, **fields):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_span(phase, time.monotonic() - start_time, **fields)
+
+    def record_span(self, phase, seconds, **fields):
+        # For a span that can't be wrapped in a with block, e.g. one that spans several awaits
+        with self.lock:
+            self.phase_histograms.setdefault(phase, LatencyHistogram()).add(seconds)
+        self._write_event('span', phase=phase, seconds=round(seconds, 3), **fields)
+
+    def record_row(self, row_id, seconds, outcome):
+        with self.lock:
+            self.row_histogram.add(seconds)
+            if outcome != 'deferred':
+                # A deferred row comes back later, so only its last attempt counts towards progress
+                self.finished_rows += 1
+        self._write_event('row', row_id=row_id, seconds=round(seconds, 3), outcome=outcome)
+        if self.show_progress:
+            print(self.get_progress_line())
+
+    def get_progress_line(self):
+        with self.lock:
+            finished_rows = self.finished_rows
+        elapsed_seconds = time.monotonic() - self.start_time
+        rows_per_hour = finished_rows / elapsed_seconds * 3600 if elapsed_seconds > 0 else 0
+        progress_line = f"[Progress] {finished_rows}"
+        if self.total_rows:
+            progress_line += f"/{self.total_rows} rows"
+            if rows_per_hour > 0:
+                eta_seconds = max(self.total_rows - finished_rows, 0) / rows_per_hour * 3600
+                progress_line += f" | ETA {format_duration(eta_seconds)}"
+        else:
+            progress_line += " rows"
+        return progress_line + f" | {rows_per_hour:.1f} rows/hour | elapsed {format_duration(elapsed_seconds)}"
+
+    def get_phase_seconds(self):
+        with self.lock:
+            return {phase: histogram.total_seconds for phase, histogram in self.phase_histograms.items()}
+
+    def get_wait_seconds(self):
+        with self.lock:
+            return {phase: histogram.total_seconds for phase, histogram in self.phase_histograms.items() if phase in WAIT_PHASES}
+
+    def get_summary(self):
+        wait_seconds = self.get_wait_seconds()
+        with self.lock:
+            summary_lines = [f"Run telemetry ({self.finished_rows} row(s), {format_duration(time.monotonic() - self.start_time)} elapsed)"]
+            histograms = [('row', self.row_histogram)] + sorted(self.phase_histograms.items())
+            for name, histogram in histograms:
+                if histogram.count == 0:
+                    continue
+                summary_lines.append(
+                    f"  {name:<18} n={histogram.count:<6} total={histogram.total_seconds:>9.1f}s "
+                    f"mean={histogram.total_seconds / histogram.count:>6.1f}s "
+                    f"p50<={histogram.percentile(50):.1f}s p95<={histogram.percentile(95):.1f}s max={histogram.max_seconds:.1f}s"
+                )
+                summary_lines.append(f"  {'':<18} {histogram.format_buckets()}")
+        wait_breakdown = ', '.join(f"{phase}: {seconds:.1f}s" for phase, seconds in sorted(wait_seconds.items()))
+        summary_lines.append(f"  Waits total: {sum(wait_seconds.values()):.1f}s" + (f" ({wait_breakdown})" if wait_breakdown else ""))
+        return '\n'.join(summary_lines)
+
+    def close(self):
+        with self.lock:
+            if self.events_file is not None and not self.events_file.closed:
+                self.events_file.close()
+
+    def _write_event(self, event, **fields):
+        if self.events_file is None:
+            return
+        event_record = {
+            'timestamp': round(time.time(), 3),
+            'event': event,
+            'row_id': getattr(self.local, 'row_id', None),
+            'attempt': getattr(self.local, 'attempt', None),
+            'worker': getattr(self.local, 'worker', None),
+        }
+        event_record.update(fields)
+        with self.lock:
+            if not self.events_file.closed:
+                self.events_file.write(json.dumps(event_record, default=str) + '\n')
+                self.events_file.flush()
+
+class NullTelemetry(RunTelemetry):
+    # Used when no telemetry is passed in: keeps the timing calls in the helpers unconditional
+    def __init__(self):
+        super().__init__()
+
+    @contextmanager
+    def row_context(self, row_id, worker):
+        yield
+
+    def set_attempt(self, attempt):
+        pass
+
+    @contextmanager
+    def span(self, phase, **fields):
+        yield
+
+    def record_span(self, phase, seconds, **fields):
+        pass
+
+    def record_row(self, row_id, seconds, outcome):
+        pass
+
+NULL_TELEMETRY = NullTelemetry()
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
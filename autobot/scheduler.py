@@ -0,0 +1,155 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from run_telemetry import NULL_TELEMETRY
+
+class NoBackendsLeftError(RuntimeError):
+    pass
+
+class SessionLostError(RuntimeError):
+    # Raised by process_row when its backend can't be used any more, e.g. once its recovery ladder is
+    # exhausted. The row goes back on the queue for the other backends and this one is retired
+    pass
+
+class RetryLater:
+    # Returned by process_row to send the row again after delay_seconds. Deferred rows only go out
+    # once the main queue is empty, so one stubborn prompt never holds up the rest of the run
+    def __init__(self, delay_seconds):
+        self.delay_seconds = delay_seconds
+
+class RequeueRows:
+    # Returned by process_row to put rows back at the front of the queue as separate items, e.g. the
+    # rows of a batch whose answers couldn't be split out of the reply
+    def __init__(self, rows):
+        self.rows = rows
+
+async def schedule_rows(backends, rows, process_row, max_concurrency=None, row_timeout=None, get_row_route=None, get_backend_route=None, max_buffered_rows=None, telemetry=NULL_TELEMETRY):
+    # Every backend pulls rows from one shared source, so a slow session never holds up the others.
+    # rows can be any iterable. It is only advanced as backends free up, so a lazy reader only ever
+    # holds its current chunk plus the rows in flight.
+    # With get_row_route/get_backend_route a backend only takes the rows routed to it, e.g. the rows of
+    # its model/style configuration. Rows read for another route wait in that route's queue, and once
+    # one of those queues holds max_buffered_rows a backend waits for that route to catch up instead of
+    # reading further. Rows of a route with no backend left are only counted, not kept.
+    # The blocking send/wait cycle of a row runs in a worker thread while the event loop keeps the
+    # bookkeeping: at most max_concurrency rows are in flight, a row slower than row_timeout is
+    # re-queued for another backend (as is the row of a backend that raises SessionLostError) and the
+    # cancelled event passed to its process_row is set, so its late result is dropped, a row
+    # whose process_row returns RetryLater is deferred to the end of the run, and any other failure
+    # cancels the rest of the run. The time a backend sits idle while rows wait out their retry backoff
+    # is recorded as a 'retry_backoff' span
+    loop = asyncio.get_running_loop()
+    row_iterator = iter(rows)
+    rows_exhausted = False
+    get_row_route = get_row_route or (lambda row: None)
+    get_backend_route = get_backend_route or (lambda backend: None)
+    # Per route: rows handed back by a timed-out backend or read ahead for that route
+    queues = collections.defaultdict(collections.deque)
+    semaphore = asyncio.Semaphore(max_concurrency or len(backends))
+    # A dedicated pool, so a thread stuck on a timed-out row doesn't hold up the end of the run
+    executor = ThreadPoolExecutor(max_workers=len(backends))
+    rows_in_flight = 0
+    deferred_rows = collections.defaultdict(list) # Per route, a heap of (ready_time, tie_breaker, row)
+    deferred_row_order = itertools.count()
+    live_backends = collections.Counter(get_backend_route(backend) for backend in backends) # Per route
+    dropped_rows = 0
+
+    def is_read_ahead_full(route):
+        if max_buffered_rows is None:
+            return False
+        return any(len(queue) >= max_buffered_rows for other_route, queue in queues.items() if other_route != route and live_backends[other_route])
+
+    def get_next_row(route):
+        nonlocal rows_exhausted, dropped_rows
+        if queues[route]:
+            return queues[route].popleft()
+        while not rows_exhausted and not is_read_ahead_full(route):
+            row = next(row_iterator, None)
+            if row is None:
+                rows_exhausted = True
+            elif get_row_route(row) == route:
+                return row
+            elif live_backends[get_row_route(row)]:
+                queues[get_row_route(row)].append(row)
+            else:
+                dropped_rows += 1
+        if deferred_rows[route] and deferred_rows[route][0][0] <= time.monotonic():
+            return heapq.heappop(deferred_rows[route])[2]
+        return None
+
+    async def run_backend(backend):
+        nonlocal rows_in_flight
+        route = get_backend_route(backend)
+        backoff_wait_start = None
+        while True:
+            row = get_next_row(route)
+            if backoff_wait_start is not None and (row is not None or not deferred_rows[route]):
+                telemetry.record_span('retry_backoff', time.monotonic() - backoff_wait_start, worker=backend.name)
+                backoff_wait_start = None
+            if row is None:
+                if rows_exhausted and rows_in_flight == 0 and not deferred_rows[route]:
+                    return
+                if deferred_rows[route] and backoff_wait_start is None:
+                    backoff_wait_start = time.monotonic()
+                # A row still in flight elsewhere may time out or be deferred, deferred rows wait out their
+                # backoff, and a full read-ahead waits for the other routes to drain their queues
+                await asyncio.sleep(0.1)
+                continue
+            rows_in_flight += 1
+            cancelled = threading.Event()
+            try:
+                async with semaphore:
+                    result = await asyncio.wait_for(loop.run_in_executor(executor, process_row, backend, row, cancelled), timeout=row_timeout)
+                if isinstance(result, RetryLater):
+                    heapq.heappush(deferred_rows[route], (time.monotonic() + result.delay_seconds, next(deferred_row_order), row))
+                elif isinstance(result, RequeueRows):
+                    for requeued_row in result.rows:
+                        queues[get_row_route(requeued_row)].append(requeued_row)
+            except asyncio.TimeoutError:
+                # The thread can't be interrupted and keeps the session busy, so the backend is retired
+                print(f"[{backend.name}] Row timed out after {row_timeout}s. Re-queuing it and retiring this session")
+                cancelled.set()
+                queues[route].append(row)
+                live_backends[route] -= 1
+                return
+            except SessionLostError as e:
+                print(f"[{backend.name}] {e}. Re-queuing the row and retiring this session")
+                queues[route].append(row)
+                live_backends[route] -= 1
+                return
+            finally:
+                rows_in_flight -= 1
+
+    tasks = [asyncio.create_task(run_backend(backend)) for backend in backends]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    rows_left = sum(len(queue) for queue in queues.values()) + sum(len(heap) for heap in deferred_rows.values()) + dropped_rows
+    if rows_left or not rows_exhausted:
+        unread_rows = sum(1 for _ in row_iterator) if not rows_exhausted else 0
+        raise NoBackendsLeftError(f"{rows_left + unread_rows} row(s) left unprocessed because every session was retired")
+
+def run_scheduler(backends, rows, process_row, max_concurrency=None, row_timeout=None, get_row_route=None, get_backend_route=None, max_buffered_rows=None, telemetry=NULL_TELEMETRY):
+    return asyncio.run(schedule_rows(
+        backends=backends,
+        rows=rows,
+        process_row=process_row,
+        max_concurrency=max_concurrency,
+        row_timeout=row_timeout,
+        get_row_route=get_row_route,
+        get_backend_route=get_backend_route,
+        max_buffered_rows=max_buffered_rows,
+        telemetry=telemetry,
+        ))
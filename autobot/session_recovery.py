@@ -0,0 +1,85 @@
+from selenium.common.exceptions import WebDriverException
+
+from run_telemetry import NULL_TELEMETRY
+from scheduler import SessionLostError
+from browser_setup import wait_for_login
+from helper_functions import close_notification_box
+
+# Tried in this order, one step further for every consecutive failure of the same prompt
+RECOVERY_STEPS = ['dismiss_toast', 'refresh_page', 'new_chat', 'restart_browser']
+
+class SessionRecovery:
+    # Recovery ladder of one browser session. A failed send (a stalled page, an intercepted click, a
+    # crashed browser) climbs one step per consecutive failure of the same prompt, and the prompt is
+    # sent again after each step. Finished rows are already in the result sink and the run journal,
+    # so even a browser restart loses no progress. Once the ladder is exhausted SessionLostError
+    # retires the session and its row goes to the other sessions
+    def __init__(
+            self,
+            restart_driver=None,
+            login_timeout=30,
+            max_steps=len(RECOVERY_STEPS),
+            max_browser_restarts=2,
+            telemetry=NULL_TELEMETRY,
+    ):
+        # restart_driver opens a new session on the chat page, None to never restart the browser
+        self.restart_driver = restart_driver
+        self.login_timeout = login_timeout
+        self.max_steps = min(max_steps, len(RECOVERY_STEPS))
+        self.max_browser_restarts = max_browser_restarts
+        self.telemetry = telemetry
+        self.browser_restarts = 0
+        self.step_counts = {step: 0 for step in RECOVERY_STEPS}
+
+    def recover(self, backend, failure_count, error):
+        if failure_count > self.max_steps:
+            raise SessionLostError(f"Still failing after {self.max_steps} recovery step(s): {error}")
+        step = RECOVERY_STEPS[failure_count - 1]
+        if step != 'restart_browser' and not is_browser_alive(backend.driver):
+            # Nothing short of a restart helps once the browser itself is gone
+            step = 'restart_browser'
+        print(f"[{backend.name}] {type(error).__name__}: {error}")
+        print(f"[{backend.name}] Recovery step {failure_count}/{self.max_steps}: {step}")
+        self.step_counts[step] += 1
+        with self.telemetry.span('recovery', step=step):
+            try:
+                if step == 'dismiss_toast':
+                    close_notification_box(backend.driver)
+                elif step == 'refresh_page':
+                    backend.driver.refresh()
+                    if not wait_for_login(backend.driver, self.login_timeout):
+                        print(f"[{backend.name}] Chat page not back within {self.login_timeout}s of the refresh")
+                elif step == 'new_chat':
+                    backend.chat_session.request_new_chat()
+                else:
+                    self.restart_browser(backend)
+            except WebDriverException as e:
+                # The next send shows whether the page recovered anyway; if not, the next step is tried
+                print(f"[{backend.name}] Recovery step {step} failed: {e.msg}")
+
+    def restart_browser(self, backend):
+        if self.restart_driver is None:
+            raise SessionLostError("Browser restarts are not available for this session")
+        if self.browser_restarts >= self.max_browser_restarts:
+            raise SessionLostError(f"Browser already restarted {self.browser_restarts} time(s)")
+        try:
+            backend.driver.quit()
+        except WebDriverException:
+            pass # Already gone
+        self.browser_restarts += 1
+        driver = self.restart_driver()
+        if not wait_for_login(driver, self.login_timeout):
+            driver.quit()
+            raise SessionLostError("The restarted browser is not logged in. Use --chrome_profile_dir or --cookies_path to keep the login")
+        backend.replace_driver(driver)
+
+    def get_summary(self):
+        steps_taken = ', '.join(f"{step} x{count}" for step, count in self.step_counts.items() if count)
+        return steps_taken or 'none needed'
+
+def is_browser_alive(driver):
+    try:
+        driver.execute_script('return 1')
+        return True
+    except WebDriverException:
+        return False
@@ -0,0 +1,314 @@
+import os
+import hmac
+import json
+import time
+import functools
+import sqlite3
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from result_sink import to_builtin_value
+from run_journal import RETRY_OUTPUTS
+
+WORK_QUEUE_STATES = ['queued', 'leased', 'writing', 'done']
+# Header every worker request has to carry the coordinator's token in
+TOKEN_HEADER = 'X-Work-Queue-Token'
+
+class LeaseQueue:
+    # Crash-safe queue of prompt rows shared by the workers of a distributed run, stored in SQLite (WAL
+    # mode). A worker leases one row at a time; a lease that isn't renewed within lease_seconds (the
+    # worker died or lost its network) puts the row back in the queue, so a crashed node costs at most
+    # the rows it had in flight. The first result reported for a row wins, later ones are ignored. A
+    # row is 'writing' from its first result until that result is on disk, and only then 'done'
+    def __init__(self, path, lease_seconds=300):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                prompt_id TEXT PRIMARY KEY,
+                row_json TEXT NOT NULL,
+                state TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                not_before REAL NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                retries INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_state_position ON tasks (state, position)")
+        # The coordinator stopped before these results were on disk, so the rows have to be answered again
+        self.connection.execute("UPDATE tasks SET state = 'queued', lease_owner = NULL WHERE state = 'writing'")
+        self.next_position = self.connection.execute("SELECT COALESCE(MAX(position), 0) + 1 FROM tasks").fetchone()[0]
+
+    def enqueue(self, rows):
+        # Rows already known (e.g. still leased when the coordinator restarted) keep their state
+        with self.lock:
+            self.connection.execute("BEGIN")
+            for row in rows:
+                row_json = json.dumps({column: to_builtin_value(value) for column, value in row.items()}, default=str)
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO tasks (prompt_id, row_json, state, position) VALUES (?, ?, 'queued', ?)",
+                    (str(row['prompt_id']), row_json, self.next_position),
+                )
+                self.next_position += 1
+            self.connection.execute("COMMIT")
+
+    def lease(self, worker_id):
+        # Returns (row, attempt) for the next ready row, or None if there is none right now
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            expired_rows = self.connection.execute(
+                "SELECT prompt_id, lease_owner FROM tasks WHERE state = 'leased' AND lease_expires_at < ?", (now,),
+            ).fetchall()
+            for prompt_id, lease_owner in expired_rows:
+                print(f"Lease of prompt_id {prompt_id} held by {lease_owner} expired. Re-queuing it")
+            self.connection.execute(
+                "UPDATE tasks SET state = 'queued', lease_owner = NULL WHERE state = 'leased' AND lease_expires_at < ?", (now,),
+            )
+            task = self.connection.execute(
+                "SELECT prompt_id, row_json, retries FROM tasks WHERE state = 'queued' AND not_before <= ? ORDER BY position LIMIT 1", (now,),
+            ).fetchone()
+            if task is not None:
+                self.connection.execute(
+                    "UPDATE tasks SET state = 'leased', lease_owner = ?, lease_expires_at = ? WHERE prompt_id = ?",
+                    (worker_id, now + self.lease_seconds, task[0]),
+                )
+            self.connection.execute("COMMIT")
+        if task is None:
+            return None
+        return json.loads(task[1]), task[2] + 1
+
+    def renew(self, worker_id, prompt_ids):
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE tasks SET lease_expires_at = ? WHERE prompt_id = ? AND state = 'leased' AND lease_owner = ?",
+                [(time.time() + self.lease_seconds, str(prompt_id), worker_id) for prompt_id in prompt_ids],
+            )
+
+    def release(self, worker_id, prompt_id, delay_seconds=0, retry=False):
+        # A retried row goes to the back of the queue and only comes out again after delay_seconds
+        with self.lock:
+            self.connection.execute(
+                """
+                UPDATE tasks SET state = 'queued', lease_owner = NULL, not_before = ?, position = ?, retries = retries + ?
+                WHERE prompt_id = ? AND state = 'leased' AND lease_owner = ?
+                """,
+                (time.time() + delay_seconds, self.next_position, 1 if retry else 0, str(prompt_id), worker_id),
+            )
+            self.next_position += 1
+
+    def claim_result(self, prompt_id):
+        # True if this is the row's first result
+        with self.lock:
+            cursor = self.connection.execute("UPDATE tasks SET state = 'writing' WHERE prompt_id = ? AND state IN ('queued', 'leased')", (str(prompt_id),))
+        return cursor.rowcount == 1
+
+    def abandon_result(self, prompt_id):
+        # The claimed result couldn't be written; the worker still holds the lease and may send it again
+        with self.lock:
+            self.connection.execute(
+                "UPDATE tasks SET state = 'leased', lease_expires_at = ? WHERE prompt_id = ? AND state = 'writing'",
+                (time.time() + self.lease_seconds, str(prompt_id)),
+            )
+
+    def complete(self, prompt_id):
+        # Called once the claimed result is on disk
+        with self.lock:
+            self.connection.execute("UPDATE tasks SET state = 'done', lease_owner = NULL WHERE prompt_id = ? AND state = 'writing'", (str(prompt_id),))
+
+    def count_state(self, state):
+        # Served from the (state, position) index, so it doesn't grow with the finished rows of other states
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM tasks WHERE state = ?", (state,)).fetchone()[0]
+
+    def get_state_counts(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        state_counts = {state: 0 for state in WORK_QUEUE_STATES}
+        state_counts.update(dict(rows))
+        return state_counts
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def remove(self):
+        self.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+class WorkQueueCoordinator:
+    # Serves the rows of a run to remote workers and records what they send back in the run's result
+    # sink, journal and dead-letter file. Rows are pulled from the (streamed) pending rows only as the
+    # queue runs low, so the input is never loaded whole
+    def __init__(
+            self,
+            lease_queue,
+            rows,
+            result_sink,
+            journal,
+            dead_letter_sink,
+            settings,
+            token,
+            telemetry,
+            min_queued_rows=100,
+    ):
+        self.lease_queue = lease_queue
+        self.row_iterator = iter(rows)
+        self.rows_exhausted = False
+        self.result_sink = result_sink
+        self.journal = journal
+        self.dead_letter_sink = dead_letter_sink
+        self.settings = settings
+        self.token = token
+        self.telemetry = telemetry
+        self.min_queued_rows = min_queued_rows
+        self.fill_lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def fill(self):
+        with self.fill_lock:
+            if self.rows_exhausted or self.lease_queue.count_state('queued') >= self.min_queued_rows:
+                return
+            rows = []
+            while len(rows) < self.min_queued_rows:
+                row = next(self.row_iterator, None)
+                if row is None:
+                    self.rows_exhausted = True
+                    break
+                rows.append(row)
+            self.lease_queue.enqueue(rows)
+
+    def is_finished(self):
+        # Rows still 'writing' are done as far as the workers go; they are completed when the sink is flushed
+        return self.rows_exhausted and self.lease_queue.count_state('queued') == 0 and self.lease_queue.count_state('leased') == 0
+
+    def handle(self, path, payload):
+        # One JSON request from a worker; returns the JSON response
+        if path == '/settings':
+            return self.settings
+        if path == '/lease':
+            self.fill()
+            lease = self.lease_queue.lease(payload['worker_id'])
+            if lease is None:
+                finished = self.is_finished()
+                if finished:
+                    self.finished.set()
+                return {'row': None, 'finished': finished}
+            row, attempt = lease
+            if self.journal is not None:
+                self.journal.mark_sent(row['prompt_id'])
+            print(f"Leased prompt_id {row['prompt_id']} (attempt {attempt}) to {payload['worker_id']}")
+            return {'row': row, 'attempt': attempt}
+        if path == '/renew':
+            self.lease_queue.renew(payload['worker_id'], payload['prompt_ids'])
+            return {}
+        if path == '/release':
+            self.lease_queue.release(payload['worker_id'], payload['prompt_id'], payload.get('delay_seconds', 0), payload.get('retry', False))
+            return {}
+        if path == '/complete':
+            prompt_id = payload['row']['prompt_id']
+            if not self.lease_queue.claim_result(prompt_id):
+                print(f"Ignoring a repeated result for prompt_id {prompt_id} from {payload['worker_id']}")
+                return {'accepted': False}
+            # The queue only lets go of the row once the sink has it on disk, so a crash or a failed
+            # write in between leaves it to be answered again instead of dropping it
+            on_durable = functools.partial(self.complete_durable_row, prompt_id, payload['output'], payload['latency_seconds'])
+            try:
+                self.result_sink.add(prompt_id, payload['row'], on_durable=on_durable)
+            except Exception:
+                self.lease_queue.abandon_result(prompt_id)
+                raise
+            self.telemetry.record_row(prompt_id, payload['latency_seconds'], 'failed' if payload['output'] in RETRY_OUTPUTS else 'done')
+            return {'accepted': True}
+        if path == '/dead_letter':
+            self.dead_letter_sink.add(payload['row']['prompt_id'], payload['row'])
+            return {}
+        raise KeyError(path)
+
+    def complete_durable_row(self, prompt_id, output, latency_seconds):
+        if self.journal is not None:
+            self.journal.mark_finished(prompt_id, output, latency_seconds)
+        self.lease_queue.complete(prompt_id)
+
+    def build_request_handler(self):
+        coordinator = self
+
+        class WorkQueueRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), coordinator.token):
+                    self.send_json(403, {'error': 'invalid token'})
+                    return
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    response = coordinator.handle(self.path, payload)
+                except KeyError as e:
+                    self.send_json(400, {'error': f"bad request: {e}"})
+                    return
+                self.send_json(200, response)
+
+            def send_json(self, status, response):
+                body = json.dumps(response, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Leases and results are printed by the coordinator itself
+
+        return WorkQueueRequestHandler
+
+def serve_work_queue(
+        address,
+        queue_path,
+        rows,
+        result_sink,
+        journal,
+        dead_letter_sink,
+        settings,
+        token,
+        telemetry,
+        lease_seconds=300,
+        linger_seconds=10,
+):
+    # Blocks until every row has been answered by a worker. address is 'host:port'. The server stays
+    # up for linger_seconds after that, so polling workers learn the run is over instead of timing out
+    host, _, port = address.rpartition(':')
+    lease_queue = LeaseQueue(queue_path, lease_seconds=lease_seconds)
+    coordinator = WorkQueueCoordinator(
+        lease_queue=lease_queue,
+        rows=rows,
+        result_sink=result_sink,
+        journal=journal,
+        dead_letter_sink=dead_letter_sink,
+        settings=dict(settings, lease_seconds=lease_seconds),
+        token=token,
+        telemetry=telemetry,
+        )
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), coordinator.build_request_handler())
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print(f"Work queue coordinator listening on http://{host or '0.0.0.0'}:{server.server_address[1]} (queue: {queue_path})")
+    try:
+        coordinator.fill()
+        while not coordinator.finished.wait(timeout=5):
+            if coordinator.is_finished():
+                break
+        time.sleep(linger_seconds)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Writes out a buffered parquet row group, which completes its rows in the queue
+    result_sink.flush()
+    print(f"Work queue finished: {lease_queue.get_state_counts()}")
+    lease_queue.remove()
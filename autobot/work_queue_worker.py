@@ -0,0 +1,193 @@
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+
+from work_queue import TOKEN_HEADER
+from worker_pool import RowCounter, process_row
+from scheduler import RetryLater, SessionLostError
+from run_telemetry import NULL_TELEMETRY
+
+class WorkQueueClient:
+    # Worker side of a distributed run. Rows are leased from the coordinator one at a time and the
+    # leases of rows in flight are renewed in the background, so only a dead worker lets them expire.
+    # It stands in for the result sink and the run journal of process_row: a finished row is held
+    # until the journal is told it's finished and then sent to the coordinator in one request
+    def __init__(self, url, token, worker_id, poll_seconds=2, max_request_retries=5, request_timeout=30):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.worker_id = worker_id
+        self.poll_seconds = poll_seconds
+        self.max_request_retries = max_request_retries
+        self.request_timeout = request_timeout
+        self.lock = threading.Lock()
+        self.held_prompt_ids = set()
+        self.finished_rows = {}
+        self.queue_finished = False
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+
+    def request(self, path, payload=None):
+        body = json.dumps(dict(payload or {}, worker_id=self.worker_id), default=str).encode('utf-8')
+        for retry in range(self.max_request_retries + 1):
+            http_request = urllib.request.Request(
+                self.url + path,
+                data=body,
+                headers={'Content-Type': 'application/json', TOKEN_HEADER: self.token},
+                )
+            try:
+                with urllib.request.urlopen(http_request, timeout=self.request_timeout) as response:
+                    return json.loads(response.read())
+            except urllib.error.HTTPError:
+                raise # The coordinator answered, so retrying won't help
+            except OSError as e:
+                if retry == self.max_request_retries:
+                    raise ConnectionError(f"Work queue coordinator at {self.url} unreachable: {e}")
+                time.sleep(min(2 ** retry, 30))
+
+    def get_settings(self):
+        return self.request('/settings')
+
+    def start_heartbeat(self, lease_seconds):
+        def renew_leases():
+            while not self.stop_heartbeat.wait(timeout=lease_seconds / 3):
+                with self.lock:
+                    prompt_ids = list(self.held_prompt_ids)
+                if prompt_ids:
+                    try:
+                        self.request('/renew', {'prompt_ids': prompt_ids})
+                    except (ConnectionError, urllib.error.HTTPError) as e:
+                        print(f"Could not renew the leases of {len(prompt_ids)} row(s): {e}")
+
+        self.heartbeat_thread = threading.Thread(target=renew_leases, daemon=True)
+        self.heartbeat_thread.start()
+
+    def lease(self, telemetry=NULL_TELEMETRY):
+        # Waits for the next row. Returns (row, attempt), or None once the coordinator has no rows left
+        while not self.queue_finished:
+            response = self.request('/lease')
+            if response['row'] is not None:
+                with self.lock:
+                    self.held_prompt_ids.add(response['row']['prompt_id'])
+                return response['row'], response['attempt']
+            if response['finished']:
+                self.queue_finished = True
+                break
+            # Every row is leased or waiting out a retry backoff
+            with telemetry.span('queue_wait'):
+                time.sleep(self.poll_seconds)
+        return None
+
+    def release(self, prompt_id, delay_seconds=0, retry=False):
+        with self.lock:
+            self.held_prompt_ids.discard(prompt_id)
+            self.finished_rows.pop(prompt_id, None)
+        self.request('/release', {'prompt_id': prompt_id, 'delay_seconds': delay_seconds, 'retry': retry})
+
+    def add(self, prompt_id, row, on_durable=None):
+        # The row is only safe once the coordinator has it, which on_durable (the journal's
+        # mark_finished) takes care of
+        with self.lock:
+            self.finished_rows[prompt_id] = row
+        if on_durable is not None:
+            on_durable()
+
+    def mark_sent(self, prompt_id):
+        pass # The coordinator marks a row as sent when it's leased
+
+    def mark_finished(self, prompt_id, output, latency_seconds):
+        with self.lock:
+            row = self.finished_rows.pop(prompt_id)
+        self.request('/complete', {'row': row, 'output': output, 'latency_seconds': latency_seconds})
+        with self.lock:
+            self.held_prompt_ids.discard(prompt_id)
+
+    def close(self):
+        # Rows still held go straight back to the queue instead of waiting for their lease to expire
+        self.stop_heartbeat.set()
+        with self.lock:
+            prompt_ids = list(self.held_prompt_ids)
+        for prompt_id in prompt_ids:
+            try:
+                self.release(prompt_id)
+            except (ConnectionError, urllib.error.HTTPError):
+                pass # Its lease expires on the coordinator instead
+
+class RemoteDeadLetterSink:
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, prompt_id, row, on_durable=None):
+        self.client.request('/dead_letter', {'row': row})
+
+def run_work_queue_worker(
+        backends,
+        client,
+        prompt_column_name,
+        output_column_name,
+        response_cache=None,
+        telemetry=NULL_TELEMETRY,
+        retry_policy=None,
+):
+    # One thread per backend, each leasing and processing one row at a time until the coordinator
+    # runs out of rows. A rejected output goes back to the coordinator with its backoff, so any
+    # worker may pick up the retry
+    row_counter = RowCounter(None)
+    dead_letter_sink = RemoteDeadLetterSink(client)
+    errors = []
+
+    def release_row(prompt_id):
+        # The coordinator may be the reason the row failed; if it can't be reached its lease expires instead
+        try:
+            client.release(prompt_id)
+        except (ConnectionError, urllib.error.HTTPError) as e:
+            print(f"Could not hand prompt_id {prompt_id} back to the coordinator: {e}")
+
+    def run_backend(backend):
+        while True:
+            try:
+                lease = client.lease(telemetry=telemetry)
+            except Exception as e:
+                errors.append(e)
+                return
+            if lease is None:
+                return
+            row, attempt = lease
+            try:
+                result = process_row(
+                    backend=backend,
+                    row=row,
+                    result_sink=client,
+                    row_counter=row_counter,
+                    prompt_column_name=prompt_column_name,
+                    output_column_name=output_column_name,
+                    journal=client,
+                    response_cache=response_cache,
+                    telemetry=telemetry,
+                    retry_policy=retry_policy,
+                    dead_letter_sink=dead_letter_sink,
+                    attempt=attempt,
+                    )
+            except SessionLostError as e:
+                print(f"[{backend.name}] Session lost ({e}). Handing prompt_id {row['prompt_id']} back to the coordinator")
+                release_row(row['prompt_id'])
+                return
+            except Exception as e:
+                errors.append(e)
+                release_row(row['prompt_id'])
+                return
+            if isinstance(result, RetryLater):
+                try:
+                    client.release(row['prompt_id'], delay_seconds=result.delay_seconds, retry=True)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+    threads = [threading.Thread(target=run_backend, args=(backend,), name=backend.name) for backend in backends]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
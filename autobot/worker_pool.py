@@ -0,0 +1,296 @@
+import time
+import functools
+import threading
+import pandas as pd
+from datetime import datetime, timezone
+
+from run_journal import RETRY_OUTPUTS
+from retry_policy import REJECTED_OUTPUT
+from scheduler import run_scheduler, RetryLater, RequeueRows, SessionLostError
+from prompt_batching import build_batch_prompt, split_batch_response, iter_prompt_batches
+from run_telemetry import NULL_TELEMETRY
+from output_postprocessing import get_input_prompt_column
+
+class RowCounter:
+    # Numbers rows across all backends for the progress printouts. total_rows is None when the
+    # input is streamed and its length isn't known up front
+    def __init__(self, total_rows):
+        self.total_rows = total_rows
+        self.started_rows = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            self.started_rows += 1
+            return self.started_rows
+
+def process_row(
+        backend,
+        row,
+        result_sink,
+        row_counter,
+        prompt_column_name,
+        output_column_name,
+        journal=None,
+        response_cache=None,
+        telemetry=NULL_TELEMETRY,
+        retry_policy=None,
+        dead_letter_sink=None,
+        attempt=1,
+        cancelled=None,
+):
+    # cancelled is set by the scheduler once it has handed the row to another session (row_timeout),
+    # in which case the output that arrives late is dropped rather than written a second time
+    if attempt == 1:
+        row_number = row_counter.next()
+        print(f"\n\n[{backend.name}] Processing iteration {row_number}" + (f"/{row_counter.total_rows}" if row_counter.total_rows is not None else ""))
+    else:
+        print(f"\n\n[{backend.name}] Retrying prompt_id {row['prompt_id']} (attempt {attempt}" + (f"/{retry_policy.max_attempts}" if retry_policy is not None else "") + ")")
+    if journal is not None:
+        journal.mark_sent(row['prompt_id'])
+    row_start_time = time.monotonic()
+
+    with telemetry.row_context(row_id=row['prompt_id'], worker=backend.name):
+        telemetry.set_attempt(attempt)
+        cached_response = get_cached_response(backend, row[prompt_column_name], response_cache, retry_policy)
+        if cached_response is not None:
+            print(f"[{backend.name}] Response cache hit - reusing stored output")
+            latest_output, latest_send = cached_response
+        else:
+            latest_output, latest_send = backend.send_prompt(row[prompt_column_name])
+        if cancelled is not None and cancelled.is_set():
+            print(f"[{backend.name}] Dropping the late output of prompt_id {row['prompt_id']}, it was handed to another session")
+            return None
+
+        rejection_reason = retry_policy.get_rejection_reason(latest_output) if retry_policy is not None else None
+        if cached_response is None and response_cache is not None and latest_output not in RETRY_OUTPUTS and rejection_reason is None:
+            response_cache.put(row[prompt_column_name], latest_output, latest_send, configuration=backend.configuration)
+        row_seconds = time.monotonic() - row_start_time
+        if rejection_reason is not None and cached_response is None:
+            # Like the inline resends did, the next prompt (or this one's retry) starts in a fresh chat
+            backend.discard_chat()
+
+        if rejection_reason is not None and retry_policy.should_retry(attempt):
+            # Nothing is written yet: the journal keeps the row as 'sent', so a crash before the retry re-sends it
+            backoff_seconds = retry_policy.get_backoff_seconds(attempt)
+            print(f"[{backend.name}] Output rejected ({rejection_reason}). Deferring prompt_id {row['prompt_id']} for at least {backoff_seconds:.1f}s")
+            telemetry.record_row(row['prompt_id'], row_seconds, 'deferred')
+            return RetryLater(backoff_seconds)
+
+        if rejection_reason is not None:
+            print(f"[{backend.name}] Output rejected ({rejection_reason}) after {attempt} attempt(s). Sending prompt_id {row['prompt_id']} to the dead-letter file")
+            if dead_letter_sink is not None:
+                dead_letter_sink.add(row['prompt_id'], {
+                    'prompt_id': row['prompt_id'],
+                    'prompt': row[prompt_column_name],
+                    'output': latest_output,
+                    'reason': rejection_reason,
+                    'attempts': attempt,
+                    'failed_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    })
+            if latest_output not in RETRY_OUTPUTS:
+                latest_output = REJECTED_OUTPUT
+
+        write_row_output(row, latest_output, latest_send, result_sink, prompt_column_name, output_column_name, journal, row_seconds)
+
+        if cached_response is not None:
+            row_outcome = 'cache_hit'
+        elif latest_output in RETRY_OUTPUTS:
+            row_outcome = 'failed'
+        else:
+            row_outcome = 'done'
+        telemetry.record_row(row['prompt_id'], row_seconds, row_outcome)
+
+def process_batch(
+        backend,
+        batch_rows,
+        result_sink,
+        row_counter,
+        prompt_column_name,
+        output_column_name,
+        journal=None,
+        response_cache=None,
+        telemetry=NULL_TELEMETRY,
+        retry_policy=None,
+        cancelled=None,
+):
+    # Sends several rows as one numbered message and splits the reply back into per-row outputs.
+    # Rows answered from the cache skip the message; rows whose answer is missing or rejected are
+    # handed back to the scheduler to be sent on their own (and counted when they are)
+    prompt_ids = [row['prompt_id'] for row in batch_rows]
+    print(f"\n\n[{backend.name}] Processing a batch of {len(batch_rows)} prompts (prompt_id {prompt_ids[0]}-{prompt_ids[-1]})")
+    batch_start_time = time.monotonic()
+
+    with telemetry.row_context(row_id=prompt_ids, worker=backend.name):
+        rows_to_send = []
+        for row in batch_rows:
+            cached_response = get_cached_response(backend, row[prompt_column_name], response_cache, retry_policy)
+            if cached_response is None:
+                rows_to_send.append(row)
+                continue
+            print(f"[{backend.name}] Response cache hit for prompt_id {row['prompt_id']} - reusing stored output")
+            if journal is not None:
+                journal.mark_sent(row['prompt_id'])
+            row_counter.next()
+            write_row_output(row, cached_response[0], cached_response[1], result_sink, prompt_column_name, output_column_name, journal, 0)
+            telemetry.record_row(row['prompt_id'], 0, 'cache_hit')
+        if not rows_to_send:
+            return None
+        if len(rows_to_send) == 1:
+            return RequeueRows(rows_to_send)
+
+        for row in rows_to_send:
+            if journal is not None:
+                journal.mark_sent(row['prompt_id'])
+        # Each prompt is flattened the same way a single send flattens it
+        processed_prompts = [str(row[prompt_column_name]).replace('\n', ' ') for row in rows_to_send]
+        latest_output, _ = backend.send_prompt(build_batch_prompt(processed_prompts))
+        if cancelled is not None and cancelled.is_set():
+            print(f"[{backend.name}] Dropping the late reply to the batch of prompt_id {prompt_ids[0]}-{prompt_ids[-1]}, it was handed to another session")
+            return None
+        answers = split_batch_response(latest_output, len(rows_to_send)) if latest_output not in RETRY_OUTPUTS else {}
+        # The batch's latency is shared out over its rows
+        row_seconds = (time.monotonic() - batch_start_time) / len(rows_to_send)
+
+        fallback_rows = []
+        for prompt_number, (row, processed_prompt) in enumerate(zip(rows_to_send, processed_prompts), start=1):
+            answer = answers.get(prompt_number)
+            if answer is None or (retry_policy is not None and retry_policy.get_rejection_reason(answer) is not None):
+                fallback_rows.append(row)
+                continue
+            if response_cache is not None:
+                response_cache.put(row[prompt_column_name], answer, processed_prompt, configuration=backend.configuration)
+            row_counter.next()
+            write_row_output(row, answer, processed_prompt, result_sink, prompt_column_name, output_column_name, journal, row_seconds)
+            telemetry.record_row(row['prompt_id'], row_seconds, 'done')
+
+    print(f"[{backend.name}] Batch answered {len(rows_to_send) - len(fallback_rows)}/{len(rows_to_send)} prompt(s)")
+    if fallback_rows:
+        backend.discard_chat()
+        print(f"[{backend.name}] Sending prompt_id(s) {[row['prompt_id'] for row in fallback_rows]} on their own")
+        return RequeueRows(fallback_rows)
+    return None
+
+def get_cached_response(backend, prompt, response_cache, retry_policy):
+    # A stored output the current rules reject (e.g. with a stricter --validation_rules_path than when it
+    # was cached) is dropped from the cache, so the retry really sends the prompt instead of dead-lettering it
+    if response_cache is None:
+        return None
+    cached_response = response_cache.get(prompt, configuration=backend.configuration)
+    if cached_response is None or retry_policy is None:
+        return cached_response
+    rejection_reason = retry_policy.get_rejection_reason(cached_response[0])
+    if rejection_reason is None:
+        return cached_response
+    print(f"[{backend.name}] Cached output rejected ({rejection_reason}). Dropping it from the cache and sending the prompt")
+    response_cache.remove(prompt, configuration=backend.configuration)
+    return None
+
+def write_row_output(row, latest_output, latest_send, result_sink, prompt_column_name, output_column_name, journal, row_seconds):
+    current_data = dict(row)
+    current_data[get_input_prompt_column(prompt_column_name)] = row[prompt_column_name]
+    current_data[prompt_column_name] = latest_send
+    current_data[output_column_name] = latest_output
+    # The journal only records the row as finished once the sink has synced it to disk (for parquet,
+    # once its row group is written), so a crash in between just re-sends it
+    on_durable = functools.partial(journal.mark_finished, row['prompt_id'], latest_output, row_seconds) if journal is not None else None
+    result_sink.add(row['prompt_id'], current_data, on_durable=on_durable)
+
+def run_worker_pool(
+        backends,
+        input_rows,
+        result_sink,
+        prompt_column_name,
+        output_column_name,
+        journal=None,
+        response_cache=None,
+        max_concurrency=None,
+        row_timeout=None,
+        telemetry=NULL_TELEMETRY,
+        retry_policy=None,
+        dead_letter_sink=None,
+        total_rows=None,
+        batch_size=1,
+        batch_max_chars=4000,
+        configurations=None,
+        max_buffered_rows=None,
+):
+    # input_rows is a DataFrame or any iterable of row dicts, e.g. a chunked reader. In a fan-out run
+    # (configurations set) the rows are per-configuration tasks and each one only goes to a backend
+    # of its configuration; at most max_buffered_rows of them are read ahead for a configuration
+    # whose backends have fallen behind
+    if isinstance(input_rows, pd.DataFrame):
+        total_rows = len(input_rows)
+        input_rows = input_rows.to_dict('records')
+    row_counter = RowCounter(total_rows)
+    row_attempts = {}
+    row_dispatches = {} # The cancelled event of each row's latest attempt
+    if batch_size > 1:
+        input_rows = iter_prompt_batches(
+            input_rows,
+            prompt_column_name,
+            batch_size,
+            batch_max_chars,
+            batch_key_column='configuration' if configurations is not None else None,
+            )
+    get_row_route = None
+    get_backend_route = None
+    if configurations is not None:
+        get_row_route = lambda item: (item[0] if isinstance(item, list) else item)['configuration']
+        get_backend_route = lambda backend: backend.configuration.name
+
+    def process_scheduled_row(backend, row, cancelled):
+        if isinstance(row, list):
+            return process_batch(
+                backend=backend,
+                batch_rows=row,
+                result_sink=result_sink,
+                row_counter=row_counter,
+                prompt_column_name=prompt_column_name,
+                output_column_name=output_column_name,
+                journal=journal,
+                response_cache=response_cache,
+                telemetry=telemetry,
+                retry_policy=retry_policy,
+                cancelled=cancelled,
+                )
+        # Rows come back through the scheduler when deferred, and only one thread handles a row at a time
+        attempt = row_attempts.get(row['prompt_id'], 0) + 1
+        previous_dispatch = row_dispatches.get(row['prompt_id'])
+        if previous_dispatch is not None and previous_dispatch.is_set():
+            # The last attempt ran past row_timeout: like a lost session, that isn't the prompt's fault
+            attempt -= 1
+        row_attempts[row['prompt_id']] = attempt
+        row_dispatches[row['prompt_id']] = cancelled
+        try:
+            return process_row(
+                backend=backend,
+                row=row,
+                result_sink=result_sink,
+                row_counter=row_counter,
+                prompt_column_name=prompt_column_name,
+                output_column_name=output_column_name,
+                journal=journal,
+                response_cache=response_cache,
+                telemetry=telemetry,
+                retry_policy=retry_policy,
+                dead_letter_sink=dead_letter_sink,
+                attempt=attempt,
+                cancelled=cancelled,
+                )
+        except SessionLostError:
+            # The session broke down, not the prompt, so the attempt isn't counted against the row
+            row_attempts[row['prompt_id']] = attempt - 1
+            raise
+
+    run_scheduler(
+        backends=backends,
+        rows=input_rows,
+        process_row=process_scheduled_row,
+        max_concurrency=max_concurrency,
+        row_timeout=row_timeout,
+        get_row_route=get_row_route,
+        get_backend_route=get_backend_route,
+        max_buffered_rows=max_buffered_rows,
+        telemetry=telemetry,
+        )
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import threading
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'autobot'))
+from browser_setup import resolve_chromedriver_path, create_chrome_driver, wait_for_login
+from chat_backends import SeleniumBackend
+from session_recovery import SessionRecovery
+from result_sink import ResultSink
+from run_journal import RETRY_OUTPUTS
+from worker_pool import run_worker_pool
+from run_telemetry import RunTelemetry
+from adaptive_timing import AdaptiveTimingController
+from output_validator import build_output_validator
+from mock_securegpt_server import DEFAULT_MOCK_CONFIG, start_mock_server
+
+def percentile(values, percent):
+    # Nearest-rank percentile, good enough for a latency report
+    if not values:
+        return None
+    ordered_values = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered_values)))
+    return ordered_values[rank - 1]
+
+def build_prompts(rows, min_prompt_chars, max_prompt_chars, seed):
+    random_generator = random.Random(seed)
+    prompts = []
+    for row_number in range(rows):
+        prompt_chars = random_generator.randint(min_prompt_chars, max_prompt_chars)
+        prompt = f"polish this text {row_number}: " + ' '.join('lorem' for _ in range(prompt_chars // 6))
+        prompts.append(prompt[:prompt_chars])
+    return pd.DataFrame({'prompt_id': range(1, rows + 1), 'my_prompt': prompts})
+
+def run_benchmark(
+        rows,
+        workers,
+        min_prompt_chars,
+        max_prompt_chars,
+        mock_config,
+        max_chat_dialogs,
+        input_text_lag_time,
+        generation_sleep_timer,
+        max_data_loading_retries,
+        retry_data_loading_wait_time,
+        headless,
+        chromedriver_path,
+        seed,
+        adaptive_timing=False,
+        disclaimer_mode='separate',
+        stall_timeout=60,
+):
+    telemetry = RunTelemetry()
+    timing_controller = None
+    if adaptive_timing:
+        timing_controller = AdaptiveTimingController(
+            max_response_timeout=generation_sleep_timer + max_data_loading_retries * retry_data_loading_wait_time,
+            max_input_timeout=input_text_lag_time,
+            )
+    server, website_url = start_mock_server(mock_config=mock_config)
+    print(f"Mock SecureGPT serving at {website_url}")
+
+    chromedriver_path = resolve_chromedriver_path(chromedriver_path)
+    backends = []
+    row_latencies = []
+    row_latencies_lock = threading.Lock()
+    for worker_id in range(workers):
+        driver = create_chrome_driver(chromedriver_path=chromedriver_path, headless=headless, lightweight_browser=True)
+        driver.get(website_url)
+        wait_for_login(driver, timeout=10)
+        backend = SeleniumBackend(
+            name=f"Worker {worker_id}",
+            driver=driver,
+            input_text_lag_time=input_text_lag_time,
+            generation_sleep_timer=generation_sleep_timer,
+            max_data_loading_retries=max_data_loading_retries,
+            retry_data_loading_wait_time=retry_data_loading_wait_time,
+            max_chat_dialogs=max_chat_dialogs,
+            disclaimer_statement="I am going to give you a prompt. Just perform the task.",
+            disclaimer_mode=disclaimer_mode,
+            output_validator=build_output_validator(terms_to_avoid=['As an AI language model', 'As a language model'], min_output_word_count=5),
+            telemetry=telemetry,
+            timing_controller=timing_controller,
+            stall_timeout=stall_timeout,
+            # Toasts from the mock are dismissed, refreshed or escaped with a new chat, never with a browser restart
+            recovery=SessionRecovery(telemetry=telemetry),
+            )
+        send_prompt = backend.send_prompt
+
+        def timed_send_prompt(prompt, send_prompt=send_prompt):
+            start_time = time.monotonic()
+            try:
+                return send_prompt(prompt)
+            finally:
+                with row_latencies_lock:
+                    row_latencies.append(time.monotonic() - start_time)
+        backend.send_prompt = timed_send_prompt
+        backends.append(backend)
+
+    input_data_df = build_prompts(rows, min_prompt_chars, max_prompt_chars, seed)
+    with tempfile.TemporaryDirectory() as sink_folder:
+        result_sink = ResultSink(
+            path=os.path.join(sink_folder, 'benchmark.partial.csv'),
+            columns=['prompt_id', 'my_prompt', 'output'],
+            )
+        start_time = time.monotonic()
+        try:
+            run_worker_pool(
+                backends=backends,
+                input_rows=input_data_df,
+                result_sink=result_sink,
+                prompt_column_name='my_prompt',
+                output_column_name='output',
+                telemetry=telemetry,
+                )
+        finally:
+            wall_seconds = time.monotonic() - start_time
+            for backend in backends:
+                backend.close()
+            server.shutdown()
+        results = result_sink.to_dataframe()
+        result_sink.close()
+
+    failed_rows = int(results['output'].isin(RETRY_OUTPUTS).sum())
+    total_row_seconds = sum(row_latencies)
+    # Spans from the bot's own telemetry
+    phase_seconds = telemetry.get_phase_seconds()
+    return {
+        'rows': rows,
+        'workers': workers,
+        'failed_rows': failed_rows,
+        'wall_seconds': round(wall_seconds, 2),
+        'prompts_per_hour': round(rows / wall_seconds * 3600, 1) if wall_seconds > 0 else None,
+        'row_latency_p50_seconds': round(percentile(row_latencies, 50), 2) if row_latencies else None,
+        'row_latency_p95_seconds': round(percentile(row_latencies, 95), 2) if row_latencies else None,
+        'phase_seconds': {phase: round(seconds, 2) for phase, seconds in phase_seconds.items()},
+        'phase_share_of_row_time': {
+            phase: round(seconds / total_row_seconds, 3) if total_row_seconds > 0 else None
+            for phase, seconds in phase_seconds.items()
+        },
+        'adaptive_timing': timing_controller.get_summary() if timing_controller is not None else None,
+        'mock_config': mock_config,
+    }
+
+def print_report(report):
+    print(f"\n\nBenchmark Report")
+    print(f"Rows: {report['rows']} ({report['failed_rows']} failed) across {report['workers']} worker(s)")
+    print(f"Wall time: {report['wall_seconds']}s")
+    print(f"Throughput: {report['prompts_per_hour']} prompts/hour")
+    print(f"Row latency: p50 {report['row_latency_p50_seconds']}s, p95 {report['row_latency_p95_seconds']}s")
+    if report['adaptive_timing'] is not None:
+        print(report['adaptive_timing'])
+    print(f"Time per phase (summed over workers):")
+    for phase, seconds in report['phase_seconds'].items():
+        share = report['phase_share_of_row_time'][phase]
+        print(f"  {phase:<16} {seconds:>9.2f}s" + (f"  ({share:.1%} of row time)" if share is not None else ""))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure Auto-SecureGPT throughput against a local mock SecureGPT page')
+    parser.add_argument('--rows', type=int, nargs='?', help='Number of prompts to send', default=20)
+    parser.add_argument('--workers', type=int, nargs='?', help='Number of concurrent browser sessions', default=1)
+    parser.add_argument('--min_prompt_chars', type=int, nargs='?', help='Shortest generated prompt', default=50)
+    parser.add_argument('--max_prompt_chars', type=int, nargs='?', help='Longest generated prompt', default=3000)
+    parser.add_argument('--max_chat_dialogs', type=int, nargs='?', help='Maximum number of chat dialogs per chat window', default=5)
+    parser.add_argument('--input_text_lag_time', type=int, nargs='?', help='Upper bound for the input to land in the search bar', default=15)
+    parser.add_argument('--generation_sleep_timer', type=int, nargs='?', help='Upper bound for a response to complete', default=50)
+    parser.add_argument('--max_data_loading_retries', type=int, nargs='?', help='Maximum retries for data loading', default=10)
+    parser.add_argument('--retry_data_loading_wait_time', type=int, nargs='?', help='Wait time between data loading retries', default=5)
+    parser.add_argument('--headed', action='store_true', help='Show the browser windows')
+    parser.add_argument('--chromedriver_path', type=str, nargs='?', help='Local chromedriver to use', default=None)
+    parser.add_argument('--seed', type=int, nargs='?', help='Seed for the generated prompts', default=0)
+    parser.add_argument('--report_path', type=str, nargs='?', help='Write the report as JSON to this path', default=None)
+    for config_name, default_value in DEFAULT_MOCK_CONFIG.items():
+        parser.add_argument(f'--mock_{config_name}', type=type(default_value), nargs='?', help='Mock SecureGPT setting', default=default_value)
+    parser.add_argument('--adaptive_timing', action='store_true', help='Learn the deadlines and polling interval from observed latencies')
+    parser.add_argument('--stall_timeout', type=float, nargs='?', help='Seconds without any change on the page before the recovery ladder starts', default=60)
+    parser.add_argument('--disclaimer_mode', type=str, choices=['separate', 'prepend'], help='Send the disclaimer on its own or in front of the first prompt of each chat', default='separate')
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        rows=args.rows,
+        workers=args.workers,
+        min_prompt_chars=args.min_prompt_chars,
+        max_prompt_chars=args.max_prompt_chars,
+        mock_config={config_name: getattr(args, f'mock_{config_name}') for config_name in DEFAULT_MOCK_CONFIG},
+        max_chat_dialogs=args.max_chat_dialogs,
+        input_text_lag_time=args.input_text_lag_time,
+        generation_sleep_timer=args.generation_sleep_timer,
+        max_data_loading_retries=args.max_data_loading_retries,
+        retry_data_loading_wait_time=args.retry_data_loading_wait_time,
+        headless=not args.headed,
+        chromedriver_path=args.chromedriver_path,
+        seed=args.seed,
+        adaptive_timing=args.adaptive_timing,
+        disclaimer_mode=args.disclaimer_mode,
+        stall_timeout=args.stall_timeout,
+        )
+    print_report(report)
+    if args.report_path is not None:
+        with open(os.path.expanduser(args.report_path), 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"\nReport saved to {args.report_path}")
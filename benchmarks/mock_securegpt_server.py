@@ -0,0 +1,202 @@
+import sys
+import json
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the SecureGPT chat page. It reproduces the DOM the bot relies on:
+# 'textarea.flex.w-full', the submit button with the 'lucide-send' icon (swapped for a stop icon
+# while generating), the 'lucide-loader animate-spin' spinner, the items-end/items-start dialog
+# containers, the 'Balanced' style button, the new-chat button and closable toasts.
+# Generation latency, streaming speed, toasts and moderation refusals are configurable.
+MOCK_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Secure GPT (Beta) - mock</title>
+<style>
+  body { font-family: sans-serif; margin: 0; }
+  .hidden { display: none; }
+  .container { border-bottom: 1px solid #ddd; padding: 8px; }
+  [toast] { position: fixed; bottom: 80px; right: 16px; background: #fee; border: 1px solid #c00; padding: 8px; }
+  form { position: fixed; bottom: 0; left: 0; right: 0; display: flex; background: #fff; padding: 8px; }
+  textarea { flex: 1; height: 48px; }
+</style>
+</head>
+<body>
+<div class="flex pb-2 items-center justify-end">
+  <button class="inline-flex items-center justify-center" id="new-chat">New chat</button>
+</div>
+<div id="styles">
+  <button data-style="Creative">Creative</button>
+  <button data-style="Balanced">Balanced</button>
+  <button data-style="Precise">Precise</button>
+</div>
+<div id="transcript"></div>
+<div id="toasts"></div>
+<form id="chat-form">
+  <textarea class="flex w-full" placeholder="Send a message"></textarea>
+  <button type="submit" id="submit"><svg class="lucide lucide-send" width="16" height="16"><rect width="16" height="16"></rect></svg></button>
+</form>
+<script>
+const CONFIG = __CONFIG__;
+const transcript = document.getElementById('transcript');
+const textarea = document.querySelector('textarea.flex.w-full');
+const submitButton = document.getElementById('submit');
+const toasts = document.getElementById('toasts');
+let inputState = '';  // Like React, the message sent is whatever the input events reported
+let generating = false;
+let chatStyle = 'Balanced';
+let messageCount = 0;
+
+textarea.addEventListener('input', (event) => { inputState = event.target.value; });
+textarea.addEventListener('keydown', (event) => {
+  if (event.key === 'Enter' && !event.shiftKey) { event.preventDefault(); submitMessage(); }
+});
+document.getElementById('chat-form').addEventListener('submit', (event) => { event.preventDefault(); submitMessage(); });
+document.getElementById('new-chat').addEventListener('click', () => {
+  // Clearing the transcript takes a moment, like the real page re-rendering
+  setTimeout(() => { transcript.innerHTML = ''; messageCount = 0; }, CONFIG.new_chat_delay_ms);
+});
+document.querySelectorAll('#styles button').forEach((button) => {
+  button.addEventListener('click', () => { chatStyle = button.dataset.style; });
+});
+
+function setSendIcon(isGenerating) {
+  submitButton.innerHTML = isGenerating
+    ? '<svg class="lucide lucide-square" width="16" height="16"></svg>'
+    : '<svg class="lucide lucide-send" width="16" height="16"><rect width="16" height="16"></rect></svg>';
+}
+
+function appendDialog(side, header, text) {
+  const container = document.createElement('div');
+  container.className = 'container mx-auto max-w-4xl py-6 flex flex-col ' + side;
+  const headerElement = document.createElement('div');
+  headerElement.textContent = header;
+  const body = document.createElement('div');
+  body.className = 'message-body';
+  body.textContent = text;
+  container.appendChild(headerElement);
+  container.appendChild(body);
+  transcript.appendChild(container);
+  return body;
+}
+
+function showToast() {
+  const toast = document.createElement('div');
+  toast.setAttribute('toast', '');
+  toast.innerHTML = 'Something went wrong. <button toast-close>x</button>';
+  toast.querySelector('button').addEventListener('click', () => toast.remove());
+  toasts.appendChild(toast);
+}
+
+function buildResponse(message) {
+  // Numbered prompts get numbered answers, so batched messages can be split back up
+  const numbered = [...message.matchAll(/### PROMPT (\\d+) ###/g)].map((match) => match[1]);
+  const filler = (count) => Array.from({ length: count }, (_, i) => 'word' + (i % 50)).join(' ');
+  if (numbered.length > 0) {
+    return numbered.map((number) => '### ANSWER ' + number + ' ###\\nAnswer ' + number + ': ' + filler(CONFIG.response_words)).join('\\n');
+  }
+  return 'Response (' + chatStyle + ') to: ' + message.slice(0, 40) + ' ' + filler(CONFIG.response_words);
+}
+
+function submitMessage() {
+  if (generating || toasts.children.length > 0 || inputState.trim() === '') {
+    return;  // A visible toast blocks sending until it is closed
+  }
+  const message = inputState;
+  inputState = '';
+  textarea.value = '';
+  generating = true;
+  messageCount += 1;
+
+  const moderated = Math.random() < CONFIG.moderation_rate;
+  if (!moderated) {
+    appendDialog('items-end', 'Test User (SU)', message);
+  }
+  const spinner = document.createElement('svg');
+  spinner.setAttribute('class', 'lucide lucide-loader animate-spin');
+  transcript.appendChild(spinner);
+  setSendIcon(true);
+
+  let response = buildResponse(message);
+  if (moderated) {
+    response = 'Your message was filtered by content moderation.';
+  } else if (Math.random() < CONFIG.refusal_rate) {
+    response = 'As an AI language model, I cannot help with that.';
+  }
+  const latencyMs = CONFIG.latency_ms + CONFIG.latency_ms_per_1k_chars * message.length / 1000;
+  setTimeout(() => {
+    spinner.remove();
+    const body = appendDialog('items-start', 'Secure GPT (Beta)', '');
+    const words = response.split(' ');
+    let shown = 0;
+    const streamStep = () => {
+      shown = Math.min(words.length, shown + CONFIG.stream_words_per_tick);
+      body.textContent = words.slice(0, shown).join(' ');
+      if (shown < words.length) {
+        setTimeout(streamStep, CONFIG.stream_tick_ms);
+      } else {
+        generating = false;
+        setSendIcon(false);
+        if (Math.random() < CONFIG.toast_rate) { showToast(); }
+      }
+    };
+    streamStep();
+  }, latencyMs);
+}
+</script>
+</body>
+</html>
+"""
+
+DEFAULT_MOCK_CONFIG = {
+    'latency_ms': 1500,
+    'latency_ms_per_1k_chars': 500,
+    'stream_words_per_tick': 5,
+    'stream_tick_ms': 50,
+    'response_words': 60,
+    'new_chat_delay_ms': 300,
+    'toast_rate': 0.0,
+    'refusal_rate': 0.0,
+    'moderation_rate': 0.0,
+}
+
+def build_mock_page(mock_config):
+    return MOCK_PAGE_TEMPLATE.replace('__CONFIG__', json.dumps(mock_config))
+
+def start_mock_server(mock_config=None, host='127.0.0.1', port=0):
+    # Serves the mock page on every path from a background thread. port=0 picks a free port
+    page = build_mock_page({**DEFAULT_MOCK_CONFIG, **(mock_config or {})}).encode('utf-8')
+
+    class MockSecureGptHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MockSecureGptHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/chat"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a local mock of the SecureGPT chat page')
+    parser.add_argument('--host', type=str, nargs='?', help='Host to bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, nargs='?', help='Port to bind', default=8765)
+    for config_name, default_value in DEFAULT_MOCK_CONFIG.items():
+        parser.add_argument(f'--{config_name}', type=type(default_value), nargs='?', default=default_value)
+    args = parser.parse_args()
+
+    mock_config = {config_name: getattr(args, config_name) for config_name in DEFAULT_MOCK_CONFIG}
+    server, website_url = start_mock_server(mock_config=mock_config, host=args.host, port=args.port)
+    print(f"Mock SecureGPT serving at {website_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)